@@ -0,0 +1,144 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from pymongo.errors import OperationFailure
+
+from metrics import SHED_REQUESTS, increment
+
+# Pipelines that join or group per customer or product, by name (see
+# aggregate() in main.py); the others are cheap totals and small breakdowns
+HEAVY_PIPELINES = {
+    'retention_by_customers', 'category_by_segment', 'quantity_by_category', 'total_orders_by_category',
+    'revenue_by_category', 'average_orders_by_customers', 'total_client', 'kpis', 'kpis_by_year',
+    'customer_revenue_percentiles', 'value_percentiles'
+}
+
+
+def pipeline_class(name):
+    return 'heavy' if name in HEAVY_PIPELINES else 'cheap'
+
+
+# maxTimeMS of each class, below the 60 s timeout of the dashboard so that the
+# server gives up before the client does
+MAX_TIME_MS = {
+    'cheap': int(os.environ.get("CHEAP_MAX_TIME_MS", 10000)),
+    'heavy': int(os.environ.get("HEAVY_MAX_TIME_MS", 45000))
+}
+
+
+def max_time_ms(name):
+    return MAX_TIME_MS[pipeline_class(name)]
+
+
+class ConcurrencyLimiter:
+    """At most `limit` pipelines of a class run at once. A request waits up to
+    `queue_timeout` seconds for a slot and is then shed with a 503 and a
+    Retry-After, rather than queueing behind a spike. Used from the event
+    loop only.
+    """
+
+    def __init__(self, name, limit, queue_timeout=0.5, retry_after=2):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.semaphore = asyncio.Semaphore(limit)
+        self.running = 0
+        self.admitted = 0
+        self.shed = 0
+
+    @asynccontextmanager
+    async def slot(self, patient=False):
+        """Hold a slot while the block runs; `patient` callers, e.g. the cache
+        warmer, wait as long as needed instead of being shed."""
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), None if patient else self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            increment(SHED_REQUESTS, **{'class': self.name})
+            raise HTTPException(
+                status_code=503, detail=f"Too many {self.name} queries running, retry later",
+                headers={'Retry-After': str(self.retry_after)}
+            )
+        self.running += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        return {'limit': self.limit, 'running': self.running, 'admitted': self.admitted, 'shed': self.shed,
+                'maxTimeMS': MAX_TIME_MS[self.name]}
+
+
+LIMITERS = {
+    'cheap': ConcurrencyLimiter('cheap', int(os.environ.get("CHEAP_CONCURRENCY", 32)), retry_after=1),
+    'heavy': ConcurrencyLimiter('heavy', int(os.environ.get("HEAVY_CONCURRENCY", 8)), retry_after=5)
+}
+
+
+def limiter(name):
+    return LIMITERS[pipeline_class(name)]
+
+
+def kill_operations(client, comment):
+    """Kill the server operations of this client tagged with `comment`, i.e.
+    the aggregate and the getMores of its cursor. Returns how many were killed."""
+    try:
+        current = list(client.admin.aggregate([
+            {'$currentOp': {'allUsers': False, 'idleConnections': False}},
+            {'$match': {'$or': [{'command.comment': comment}, {'cursor.originatingCommand.comment': comment}]}}
+        ]))
+    except OperationFailure:
+        # Not allowed to list operations: they run until their maxTimeMS
+        return 0
+    killed = 0
+    for operation in current:
+        try:
+            client.admin.command('killOp', op=operation['opid'])
+            killed += 1
+        except OperationFailure:
+            pass
+    return killed
+
+
+class CancelOnDisconnect:
+    """ASGI middleware cancelling the GET requests whose client disconnects
+    before the response is complete. It reads the messages of the server and
+    hands them to the app, which runs as a task it can cancel."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return await self.app(scope, receive, send)
+        messages = asyncio.Queue()
+        complete = False
+
+        async def send_and_track(message):
+            nonlocal complete
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                complete = True
+
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send_and_track))
+        try:
+            while True:
+                message = asyncio.ensure_future(receive())
+                await asyncio.wait({handler, message}, return_when=asyncio.FIRST_COMPLETED)
+                if handler.done():
+                    message.cancel()
+                    return handler.result()
+                if message.result()['type'] == 'http.disconnect' and not complete:
+                    handler.cancel()
+                    await asyncio.wait({handler})
+                    return
+                messages.put_nowait(message.result())
+        finally:
+            if not handler.done():
+                handler.cancel()
@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Tabular responses are asked for as Arrow IPC streams when pyarrow is available
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class ApiClient:
+    """KPI API client of the dashboard: one pooled keep-alive session and a
+    thread pool fetching endpoints concurrently.
+
+    Responses are kept as futures for `ttl` seconds, so a prefetched request
+    still in flight is shared with the page that needs it instead of being
+    sent twice. Failed requests are not kept. Past the TTL, requests are
+    revalidated with the ETag of the last body, which is reused on a 304.
+
+    With pyarrow, tabular endpoints come back as Arrow IPC streams decoded
+    into DataFrames; other responses (and all of them without pyarrow) are
+    decoded from JSON. Bodies are compressed by the API (gzip, or brotli
+    when urllib3 can decode it).
+    """
+
+    def __init__(self, base_url, max_workers=8, ttl=600, timeout=60):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if pa is not None:
+            self.session.headers["Accept"] = f"{ARROW_MEDIA_TYPE}, application/json;q=0.9"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="api")
+        self.futures = {}
+        self.validators = {}
+        self.lock = threading.Lock()
+
+    def _get(self, endpoint, params, key):
+        etag, body = self.validators.get(key, (None, None))
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.session.get(f"{self.base_url}/{endpoint}", params=params, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and etag:
+            return body
+        response.raise_for_status()
+        if response.headers.get("Content-Type", "").startswith(ARROW_MEDIA_TYPE):
+            body = pa.ipc.open_stream(pa.py_buffer(response.content)).read_all().to_pandas()
+        else:
+            body = response.json()
+        if "ETag" in response.headers:
+            self.validators[key] = (response.headers["ETag"], body)
+        return body
+
+    def _forget_failure(self, key, future):
+        if future.exception() is not None:
+            with self.lock:
+                if self.futures.get(key, (None, None))[1] is future:
+                    del self.futures[key]
+
+    def submit(self, endpoint, **params):
+        """Future of the endpoint response, shared with the pending or recent identical request."""
+        params = {name: value for name, value in params.items() if value is not None}
+        key = (endpoint, tuple(sorted(params.items())))
+        with self.lock:
+            fetched_at, future = self.futures.get(key, (0, None))
+            if future is None or time.monotonic() - fetched_at > self.ttl:
+                future = self.executor.submit(self._get, endpoint, params, key)
+                self.futures[key] = (time.monotonic(), future)
+                future.add_done_callback(lambda done: self._forget_failure(key, done))
+        return future
+
+    def fetch_all(self, calls):
+        """Results of the (endpoint, params) calls fetched concurrently, exceptions in place of failed results."""
+        futures = [self.submit(endpoint, **params) for endpoint, params in calls]
+        return [future.exception() or future.result() for future in futures]
+
+    def prefetch(self, calls):
+        for endpoint, params in calls:
+            self.submit(endpoint, **params)
@@ -1,30 +1,49 @@
-import requests
 import streamlit as st
 import pandas as pd
 import plotly.express as px
 
+from api_client import ApiClient
+
 # Base API URL
 API_URL = "http://localhost:8000"
+# Maximum number of points sent to a Plotly time series, the API downsamples beyond
+MAX_CHART_POINTS = 500
 
 # Streamlit Page Config
 st.set_page_config(page_title="E-commerce KPI Dashboard", layout="wide")
 
-# Caching Data Fetching
-@st.cache_data(ttl=600, show_spinner=False)
-def fetch_data(endpoint, year):
-    params = {"year": year if year != "All" else None}
-    try:
-        response = requests.get(f"{API_URL}/{endpoint}", params=params, timeout=60)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error fetching data from {endpoint}: {e}")
-        return []
+# Client shared by every session of the dashboard: pooled keep-alive
+# connections, concurrent fetches and a 10 minutes response cache
+@st.cache_resource
+def get_api_client():
+    return ApiClient(API_URL, max_workers=8, ttl=600)
+
+api = get_api_client()
+
+def api_call(endpoint, year, **params):
+    return endpoint, {"year": year if year != "All" else None, **params}
+
+# Fetches the (endpoint, year, params) calls concurrently
+def fetch_many(*calls):
+    results = api.fetch_all([api_call(endpoint, year, **params) for endpoint, year, params in calls])
+    for (endpoint, _, _), result in zip(calls, results):
+        if isinstance(result, Exception):
+            st.error(f"Error fetching data from {endpoint}: {result}")
+    return [[] if isinstance(result, Exception) else result for result in results]
+
+def fetch_data(endpoint, year, **params):
+    return fetch_many((endpoint, year, params))[0]
+
+# Les réponses tabulaires arrivent en DataFrame (format Arrow) ou en JSON
+def first_row(data):
+    if isinstance(data, pd.DataFrame):
+        return data.iloc[0].to_dict() if len(data) else None
+    return data or None
 
 # Caching Chart Rendering
 @st.cache_data(ttl=600, show_spinner=False)
 def render_chart(data, x_col, y_col, title, chart_type="bar"):
-    if data:
+    if len(data):
         df = pd.DataFrame(data)
         if chart_type == "bar":
             fig = px.bar(df, x=x_col, y=y_col, title=title, color=y_col)
@@ -32,12 +51,39 @@ def render_chart(data, x_col, y_col, title, chart_type="bar"):
             fig = px.scatter(df, x=x_col, y=y_col, title=title)
         st.plotly_chart(fig, use_container_width=True)
 
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_years():
+    return fetch_data("years", "All")
+
 # Sidebar Filters
-years = requests.get(f"{API_URL}/years").json()
+years = fetch_years()
 selected_year = st.sidebar.selectbox("Select Year", ["All"] + years)
 
 # Page Navigation
-page = st.sidebar.radio("Navigation", ("KPI Global", "Produits", "Clients"))
+PAGES = ("KPI Global", "Produits", "Clients")
+page = st.sidebar.radio("Navigation", PAGES)
+
+# Endpoints of each page, with their default parameters
+PAGE_ENDPOINTS = {
+    "KPI Global": [("kpis", {}), ("average_per_ship_mode", {}),
+                   ("sales_timeseries", {"bucket": "month", "points": MAX_CHART_POINTS})],
+    "Produits": [("revenue_by_category", {}), ("total_orders_by_category", {}), ("quantity_by_category", {})],
+    "Clients": [("revenue_by_segment", {}), ("total_orders_by_segment", {}), ("category_by_segment", {})],
+}
+
+# Warms the client cache in the background with the neighbouring pages of the
+# selected year and the current page of the neighbouring years, so navigating
+# does not wait on the API
+def prefetch_neighbours(page, year):
+    def neighbours(options, value):
+        position = options.index(value)
+        return options[max(position - 1, 0):position] + options[position + 1:position + 2]
+
+    neighbour_years = neighbours(["All"] + years, year)
+    neighbour_pages = neighbours(list(PAGES), page)
+    calls = [api_call(endpoint, year, **params) for other in neighbour_pages for endpoint, params in PAGE_ENDPOINTS[other]]
+    calls += [api_call(endpoint, other, **params) for other in neighbour_years for endpoint, params in PAGE_ENDPOINTS[page]]
+    api.prefetch(calls)
 
 # Function for chart navigation
 def display_chart_with_navigation(data, charts, session_key):
@@ -51,7 +97,7 @@ def display_chart_with_navigation(data, charts, session_key):
     st.title(charts["titles"][index])
 
     # Display the chart corresponding to the current index
-    if data[index]["data"]:
+    if len(data[index]["data"]):
         render_chart(
             data[index]["data"],
             data[index]["x"],
@@ -75,24 +121,18 @@ def display_chart_with_navigation(data, charts, session_key):
 if page == "KPI Global":
     st.title("📊 Tableau de bord des indicateurs globaux")
 
-    @st.cache_data(ttl=600, show_spinner=False)
-    def get_global_kpis(year):
-        return {
-            "total_sales": fetch_data("total_sales", year),
-            "total_profits": fetch_data("total_profits", year),
-            "total_orders": fetch_data("total_orders", year),
-            "total_quantity": fetch_data("total_quantity", year),
-            "total_clients": fetch_data("total_client", year),
-            "avg_orders_by_customers": fetch_data("average_orders_by_customers", year),
-        }
-
-    @st.cache_data(ttl=600, show_spinner=False)
-    def fetch_average_per_ship_mode(year):
-        return fetch_data("average_per_ship_mode", year)
-
-    # Récupération des données
-    kpis = get_global_kpis(selected_year)
-    avg_ship_mode_data = fetch_average_per_ship_mode(selected_year)
+    granularites = {"month": "Mois", "week": "Semaine", "day": "Jour"}
+    granularite = st.session_state.get("granularite", "month")
+
+    # Récupération des données en parallèle ; /kpis calcule tous les KPI globaux en un passage
+    kpis, avg_ship_mode_data, sales_timeseries, kpis_annuels = fetch_many(
+        ("kpis", selected_year, {}),
+        ("average_per_ship_mode", selected_year, {}),
+        ("sales_timeseries", selected_year, {"bucket": granularite, "points": MAX_CHART_POINTS}),
+        # Toutes les années côte à côte en un seul appel, pour la comparaison annuelle
+        ("kpis_by_year", "All", {}),
+    )
+    kpis = first_row(kpis)
 
     def afficher_carte_kpi(titre, valeur, description):
         st.markdown(
@@ -120,19 +160,19 @@ if page == "KPI Global":
     with col1:
         afficher_carte_kpi(
             "💰 Ventes totales",
-            f"{kpis['total_sales'][0].get('totalSales', 0):,.2f} €" if kpis['total_sales'] else "N/A",
+            f"{kpis['totalSales']:,.2f} €" if kpis else "N/A",
             "Revenus totaux générés par les commandes."
         )
     with col2:
         afficher_carte_kpi(
             "💸 Profits totaux",
-            f"{kpis['total_profits'][0].get('totalProfit', 0):,.2f} €" if kpis['total_profits'] else "N/A",
+            f"{kpis['totalProfit']:,.2f} €" if kpis else "N/A",
             "Profits nets après dépenses."
         )
     with col3:
         afficher_carte_kpi(
             "🛒 Commandes totales",
-            f"{kpis['total_orders'][0].get('Order ID', 0):,}" if kpis['total_orders'] else "N/A",
+            f"{kpis['totalOrders']:,}" if kpis else "N/A",
             "Nombre total de commandes traitées."
         )
 
@@ -140,25 +180,25 @@ if page == "KPI Global":
     with col4:
         afficher_carte_kpi(
             "📦 Quantité totale",
-            f"{kpis['total_quantity'][0].get('totalQuantity', 0):,}" if kpis['total_quantity'] else "N/A",
+            f"{kpis['totalQuantity']:,}" if kpis else "N/A",
             "Nombre total d'articles vendus."
         )
     with col5:
         afficher_carte_kpi(
             "👥 Clients uniques",
-            f"{kpis['total_clients'][0].get('Customers ID', 0):,}" if kpis['total_clients'] else "N/A",
+            f"{kpis['totalClients']:,}" if kpis else "N/A",
             "Nombre de clients ayant passé des commandes."
         )
     with col6:
         afficher_carte_kpi(
             "📈 Moyenne commandes/client",
-            f"{kpis['avg_orders_by_customers'][0].get('averageOrdersPerCustomer', 0):.2f}" if kpis['avg_orders_by_customers'] else "N/A",
+            f"{kpis['averageOrdersPerCustomer']:.2f}" if kpis else "N/A",
             "Nombre moyen de commandes par client."
         )
 
     # Affichage du graphique "Temps moyen par mode de livraison"
     st.subheader("⏱️ Temps moyen de livraison par mode de livraison")
-    if avg_ship_mode_data:
+    if len(avg_ship_mode_data):
         df_ship_mode = pd.DataFrame(avg_ship_mode_data)
         fig = px.bar(
             df_ship_mode,
@@ -172,22 +212,69 @@ if page == "KPI Global":
     else:
         st.warning("Aucune donnée disponible pour le temps moyen par mode de livraison.")
 
+    # Comparaison des années, avec l'évolution par rapport à l'année précédente
+    st.subheader("📅 Comparaison annuelle")
+    indicateurs = {
+        "totalSales": "Ventes (€)",
+        "totalProfit": "Profits (€)",
+        "totalOrders": "Commandes",
+        "totalQuantity": "Quantité",
+        "totalClients": "Clients uniques",
+        "averageOrdersPerCustomer": "Commandes/client",
+    }
+    indicateur = st.selectbox("Indicateur", list(indicateurs), format_func=indicateurs.get)
+    if len(kpis_annuels):
+        df_annees = pd.DataFrame(kpis_annuels)
+        df_annees["year"] = df_annees["year"].astype(str)
+        df_annees["Évolution"] = df_annees[f"{indicateur}Growth"].map(
+            lambda g: f"{g:+.1%}" if pd.notna(g) else "—"
+        )
+        fig = px.bar(
+            df_annees,
+            x="year",
+            y=indicateur,
+            text="Évolution",
+            title=f"{indicateurs[indicateur]} par année",
+            labels={"year": "Année", indicateur: indicateurs[indicateur]},
+            color=indicateur,
+        )
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.warning("Aucune donnée disponible pour la comparaison annuelle.")
+
+    # Affichage de l'évolution des ventes
+    st.subheader("📈 Évolution des ventes")
+    st.radio("Granularité", list(granularites), format_func=granularites.get, horizontal=True, key="granularite")
+    if len(sales_timeseries):
+        df_sales = pd.DataFrame(sales_timeseries)
+        fig = px.line(
+            df_sales,
+            x="date",
+            y="sales",
+            title="Évolution des ventes",
+            labels={"date": "Date", "sales": "Ventes (€)"},
+        )
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.warning("Aucune donnée disponible pour l'évolution des ventes.")
+
 
 
 elif page == "Produits":
     st.title("🛍️ Tableau de bord des produits ")
 
+    revenue, orders, quantity = fetch_many(*[(endpoint, selected_year, params) for endpoint, params in PAGE_ENDPOINTS[page]])
     product_data = [
-        {"data": fetch_data("revenue_by_category", selected_year), "x": "Category", "y": "totalSales", "chart_type": "bar"},
-        {"data": fetch_data("total_orders_by_category", selected_year), "x": "Category", "y": "totalOrders", "chart_type": "bar"},
-        {"data": fetch_data("quantity_by_category", selected_year), "x": "Category", "y": "totalQuantity", "chart_type": "doughnut"},  # Modifié ici pour un diagramme en anneau
+        {"data": revenue, "x": "Category", "y": "totalSales", "chart_type": "bar"},
+        {"data": orders, "x": "Category", "y": "totalOrders", "chart_type": "bar"},
+        {"data": quantity, "x": "Category", "y": "totalQuantity", "chart_type": "doughnut"},  # Modifié ici pour un diagramme en anneau
     ]
     product_charts = {
         "titles": ["Revenus par catégories", "Nombres de commandes par catégories", "Nombres de produits vendus par catégories"],
     }
 
     def render_chart(data, x_col, y_col, title, chart_type="bar"):
-        if data:
+        if len(data):
             df = pd.DataFrame(data)
             if chart_type == "bar":
                 fig = px.bar(df, x=x_col, y=y_col, title=title, color=y_col)
@@ -210,12 +297,13 @@ elif page == "Clients":
     st.title("📊 Tableau de bord des segments ")
 
     # Préparation des données
+    revenue, orders, top_categories = fetch_many(*[(endpoint, selected_year, params) for endpoint, params in PAGE_ENDPOINTS[page]])
     segment_data = [
-        {"data": fetch_data("revenue_by_segment", selected_year), "x": "Segment", "y": "totalRevenue",
+        {"data": revenue, "x": "Segment", "y": "totalRevenue",
          "chart_type": "bar"},
-        {"data": fetch_data("total_orders_by_segment", selected_year), "x": "Segment", "y": "TotalOrders",
+        {"data": orders, "x": "Segment", "y": "TotalOrders",
          "chart_type": "doughnut"},
-        {"data": fetch_data("category_by_segment", selected_year), "x": "Segment", "y": "TopCategory",
+        {"data": top_categories, "x": "Segment", "y": "TopCategory",
          "chart_type": "cards"},  # Spécifie que ce sera affiché avec des cards
     ]
     segment_charts = {
@@ -223,7 +311,7 @@ elif page == "Clients":
     }
 
     def render_chart(data, x_col, y_col, title, chart_type="bar"):
-        if data:
+        if len(data):
             df = pd.DataFrame(data)
             if chart_type == "bar":
                 fig = px.bar(df, x=x_col, y=y_col, title=title, color=y_col)
@@ -283,6 +371,5 @@ elif page == "Clients":
     # Navigation entre les graphiques
     display_chart_with_navigation(segment_data, segment_charts, "segments")
 
-
-
-
+# Préchargement des pages et années voisines pendant la lecture de la page
+prefetch_neighbours(page, selected_year)
@@ -0,0 +1,185 @@
+"""Load and latency benchmark of the API endpoints.
+
+Optionally loads a deterministic synthetic dataset (see synthetic.py) into a
+benchmark database of the local MongoDB, then starts one uvicorn server per
+driver mode (MONGO_DRIVER=sync|async) with the result cache, its warmer and
+the coalescing of identical requests disabled, so that every request runs its
+own pipeline, and fires concurrent requests at each endpoint, with and without
+the year filter.
+
+    python benchmark.py --orders 1000000 --requests 500 --concurrency 32 --output run.json
+    python benchmark.py --requests 500 --output new.json --compare run.json
+
+Results (p50/p95/p99 latency and throughput per mode, endpoint and filter)
+are written as JSON; --compare flags the p50/p99 regressions against a
+previous run.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+ENDPOINTS = [
+    "total_sales", "total_profits", "total_orders", "total_quantity", "kpis",
+    "ship_mode", "revenue_by_segment", "revenue_by_category", "category_by_segment"
+]
+
+
+def start_server(mode, port, database, concurrency):
+    # The admission limits are raised to the load concurrency, so that no
+    # request is shed with a 503 and left out of the latencies
+    env = dict(os.environ, MONGO_DRIVER=mode, MONGO_DB=database, CACHE_MAXSIZE="0", CACHE_WARM_INTERVAL="0",
+               CACHE_COALESCE="0", CHEAP_CONCURRENCY=str(concurrency), HEAVY_CONCURRENCY=str(concurrency))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/cache/stats", timeout=1)
+            return server, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"uvicorn did not start in {mode} mode")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run_load(url, endpoints, total, concurrency, year=None):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    params = {"year": year} if year else {}
+
+    def call(i):
+        start = time.perf_counter()
+        try:
+            response = session.get(f"{url}/{endpoints[i % len(endpoints)]}", params=params, timeout=120)
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        calls = list(pool.map(call, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, status in calls if status == 200]
+    shed = sum(1 for _, status in calls if status == 503)
+    return {
+        "requests": total,
+        # Requests refused by the admission control, not counted in the errors
+        "shed": shed,
+        "errors": total - len(latencies) - shed,
+        "req_per_s": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None
+    }
+
+
+def compare(results, baseline, threshold):
+    """Cases of `results` whose p50 or p99 grew by more than `threshold` over the baseline."""
+    previous = {(r["mode"], r["endpoint"], r["year"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["mode"], result["endpoint"], result["year"]))
+        for metric in ("p50_ms", "p99_ms"):
+            if before and before[metric] and result[metric] and result[metric] > before[metric] * threshold:
+                regressions.append(dict(
+                    mode=result["mode"], endpoint=result["endpoint"], year=result["year"], metric=metric,
+                    before=before[metric], after=result[metric]
+                ))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, help="Load this many synthetic orders first")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", default="ecommerce_bench")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint and filter")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--year", type=int, help="Year of the filtered runs, by default the latest one")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Regression ratio of --compare")
+    args = parser.parse_args()
+
+    dataset = None
+    if args.orders:
+        from pymongo import MongoClient
+        from rollup import refresh_rollup
+        from synthetic import generate
+        database = MongoClient(args.mongo_url)[args.database]
+        dataset = generate(database, args.orders, args.seed)
+        refresh_rollup(database)
+
+    endpoints = args.endpoints.split(",")
+    results = []
+    print(f"{'mode':<6} {'endpoint':<22} {'year':>5} {'req/s':>9} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} "
+          f"{'503':>5} {'errors':>6}")
+    for mode in args.modes.split(","):
+        server, url = start_server(mode, args.port, args.database, args.concurrency)
+        try:
+            year = args.year or max(requests.get(f"{url}/years", timeout=120).json(), default=None)
+            for endpoint in endpoints:
+                for filtered_year in (None, year):
+                    run_load(url, [endpoint], args.concurrency, args.concurrency, filtered_year)  # warm-up
+                    stats = run_load(url, [endpoint], args.requests, args.concurrency, filtered_year)
+                    results.append(dict(mode=mode, endpoint=endpoint, year=filtered_year, **stats))
+                    print(f"{mode:<6} {endpoint:<22} {filtered_year or 'all':>5} {stats['req_per_s']:>9.1f} "
+                          f"{stats['p50_ms'] or 0:>10.1f} {stats['p95_ms'] or 0:>10.1f} {stats['p99_ms'] or 0:>10.1f} "
+                          f"{stats['shed']:>5} {stats['errors']:>6}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": args.database,
+        "dataset": dataset,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['mode']} {r['endpoint']} {r['year'] or 'all'} {r['metric']}: "
+                  f"{r['before']:.1f} -> {r['after']:.1f} ms")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pymongo import MongoClient, ReturnDocument
+
+from metrics import COALESCED_REQUESTS, increment
+
+warming_log = logging.getLogger("cache_warmer")
+
+# Collection holding the data-version marker. Every writer of Orders, Products
+# or Customers bumps it, which invalidates the cached results of all API workers
+META_COLLECTION = 'Meta'
+DATA_VERSION_ID = 'dataVersion'
+WATCHED_COLLECTIONS = ['Orders', 'Products', 'Customers']
+
+
+def data_version(db):
+    doc = db[META_COLLECTION].find_one({'_id': DATA_VERSION_ID})
+    return doc['version'] if doc else 0
+
+
+def bump_data_version(db):
+    """Increment the data version and return the new one."""
+    doc = db[META_COLLECTION].find_one_and_update({'_id': DATA_VERSION_ID}, {'$inc': {'version': 1}},
+                                                  upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['version']
+
+
+class ResultCache:
+    """Bounded LRU cache of endpoint results with TTLs and data-version invalidation.
+
+    `version` is a callable returning the current data version; check_version()
+    polls it at most once every `version_interval` seconds and drops the whole
+    cache when it changes. The poll may block on the database, so get() does
+    not run it: callers on an event loop run check_version() in a thread first. With `stale_ttl`, expired and dropped results are kept
+    that many seconds more as stale results, for stale-while-revalidate.
+    """
+
+    def __init__(self, maxsize=256, ttl=600, version=None, version_interval=1.0, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = version
+        self.version_interval = version_interval
+        self.stale_ttl = stale_ttl
+        self.current_version = None
+        self.version_checked_at = 0.0
+        # key -> (expiry, value, computed at)
+        self.entries = OrderedDict()
+        self.stale = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _keep_stale(self, entries):
+        if not self.stale_ttl:
+            return
+        self.stale.update(entries)
+        while len(self.stale) > self.maxsize:
+            self.stale.popitem(last=False)
+
+    def check_version(self):
+        if self.version is None or time.monotonic() - self.version_checked_at < self.version_interval:
+            return
+        version = self.version()
+        with self.lock:
+            self.version_checked_at = time.monotonic()
+            if version != self.current_version:
+                if self.current_version is not None:
+                    self._keep_stale(self.entries)
+                    self.entries.clear()
+                    self.invalidations += 1
+                self.current_version = version
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                self._keep_stale({key: entry})
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def get_stale(self, key):
+        """Last result of an expired or invalidated key and its age in seconds."""
+        with self.lock:
+            entry = self.stale.get(key)
+            if entry is None:
+                return False, None, None
+            age = time.monotonic() - entry[2]
+            if age > self.stale_ttl:
+                del self.stale[key]
+                return False, None, None
+            self.stale_hits += 1
+            return True, entry[1], age
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires, value, now)
+            self.entries.move_to_end(key)
+            self.stale.pop(key, None)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, ttl=None):
+        self.check_version()
+        found, value = self.get(key)
+        if not found:
+            value = compute()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self._keep_stale(self.entries)
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'staleHits': self.stale_hits,
+                'size': len(self.entries),
+                'staleSize': len(self.stale),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'staleTtl': self.stale_ttl,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'dataVersion': self.current_version
+            }
+
+
+class SingleFlight:
+    """Shares one execution of a computation between the identical calls made
+    while it runs: the first call starts it, the others wait for its result
+    (or its exception) instead of starting their own. The run is cancelled
+    when all its callers have gone away, unless it was started detached.
+    With `coalesce` False every call starts its own run, e.g. to benchmark
+    the pipelines themselves. Used from the event loop only.
+    """
+
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
+        self.flights = {}
+        self.waiters = {}
+        self.detached = set()
+        self.executions = 0
+        self.coalesced = 0
+
+    def start(self, key, compute, detached=False):
+        """Task running the coroutine function `compute` for the key, started
+        unless one is in flight. Returns the task and whether it was joined.
+        A detached run, e.g. a background refresh, is never cancelled."""
+        task = self.flights.get(key) if self.coalesce else None
+        joined = task is not None
+        if not joined:
+            task = asyncio.ensure_future(compute())
+            self.flights[key] = task
+            self.waiters[task] = 0
+            task.add_done_callback(functools.partial(self._landed, key))
+            self.executions += 1
+        if detached:
+            self.detached.add(task)
+        return task, joined
+
+    async def run(self, key, compute):
+        """Result of `compute`, shared by the calls with the same key."""
+        task, joined = self.start(key, compute)
+        if joined:
+            self.coalesced += 1
+            increment(COALESCED_REQUESTS)
+        self.waiters[task] += 1
+        try:
+            # Shielded so that a caller going away does not cancel the run for the others
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                if task.done():
+                    del self.waiters[task]
+                elif task not in self.detached:
+                    task.cancel()
+
+    def _landed(self, key, task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        if not self.waiters.get(task):
+            self.waiters.pop(task, None)
+        self.detached.discard(task)
+        # Retrieved here in case every caller went away before the end
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {'executions': self.executions, 'coalesced': self.coalesced, 'inFlight': len(self.flights)}
+
+
+class CacheWarmer:
+    """Runs the jobs returned by the coroutine function `jobs` (name ->
+    coroutine function) at start-up and then every `interval` seconds, at most
+    `concurrency` at a time, and keeps the freshness and duration of each.
+    """
+
+    def __init__(self, jobs, interval=300, concurrency=4):
+        self.jobs = jobs
+        self.interval = interval
+        self.concurrency = concurrency
+        self.keys = {}
+        self.runs = 0
+        self.running = False
+        self.task = None
+
+    async def _refresh(self, name, job, semaphore):
+        async with semaphore:
+            stats = self.keys.setdefault(name, {'refreshes': 0, 'errors': 0, 'refreshedAt': None})
+            start = time.perf_counter()
+            try:
+                await job()
+            except Exception as e:
+                stats['errors'] += 1
+                stats['lastError'] = repr(e)
+                warming_log.warning("Warming %s failed: %r", name, e)
+            else:
+                stats['refreshes'] += 1
+                stats['refreshedAt'] = time.time()
+            stats['durationMs'] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def warm(self):
+        self.running = True
+        try:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            jobs = await self.jobs()
+            await asyncio.gather(*(self._refresh(name, job, semaphore) for name, job in jobs.items()))
+            self.runs += 1
+        finally:
+            self.running = False
+
+    async def loop(self):
+        while True:
+            try:
+                await self.warm()
+            except Exception:
+                warming_log.exception("Cache warming failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        now = time.time()
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'running': self.running,
+            'keys': {
+                name: dict(stats, ageSeconds=round(now - stats['refreshedAt'], 1) if stats['refreshedAt'] else None)
+                for name, stats in sorted(self.keys.items())
+            }
+        }
+
+
+def watch_writes(db):
+    """Bump the data version on every write to the watched collections.
+
+    Meant to run as a single side process so that writes made outside the API
+    (imports, shell updates) also invalidate the caches. Change streams need a
+    replica set or sharded cluster.
+    """
+    pipeline = [{'$match': {'ns.coll': {'$in': WATCHED_COLLECTIONS}}}]
+    with db.watch(pipeline) as stream:
+        for change in stream:
+            bump_data_version(db)
+            print(f"{change['operationType']} on {change['ns']['coll']}: data version {data_version(db)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bump the data version on every write to the watched collections")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    watch_writes(MongoClient(args.mongo_url)[args.database])
@@ -0,0 +1,393 @@
+"""In-process columnar engine answering the KPI endpoints from NumPy arrays.
+
+Orders are loaded once into a snapshot of dictionary-encoded columns, joined
+with Products and Customers at load time, and every KPI becomes a vectorized
+group-by over a boolean mask of the filters.
+
+    python columnar.py --check http://localhost:8000
+
+compares the results of every endpoint on the Orders pipelines and on this
+engine through the API; test_columnar.py does the same on a small synthetic
+dataset.
+"""
+import argparse
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from dimensions import by_category, first_products, top_category_by_segment
+
+columnar_log = logging.getLogger("columnar")
+
+ORDER_FIELDS = ['Order Date', 'Ship Date', 'Customer ID', 'Product ID', 'Segment', 'Ship Mode',
+                'Sales', 'Profit', 'Quantity']
+
+
+def encode(values):
+    """Dictionary encoding: the smallest unsigned codes array and the labels of the codes."""
+    labels = {}
+    codes = [labels.setdefault(value, len(labels)) for value in values]
+    return np.array(codes, dtype=np.min_scalar_type(max(len(labels) - 1, 0))), list(labels)
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def _date(value):
+    return value if isinstance(value, datetime) else None
+
+
+class ColumnarSnapshot:
+    """Orders as columns. Segment, Ship Mode, Customer ID and Product ID are
+    dictionary-encoded, Sales and Profit are stored as `money_dtype` (float32
+    by default, summed in float64) and dates as datetime64[ms]."""
+
+    def __init__(self, db, money_dtype=np.float32, batch_size=10000):
+        columns = {field: [] for field in ORDER_FIELDS}
+        projection = dict.fromkeys(ORDER_FIELDS, 1)
+        projection['_id'] = 0
+        for order in db.Orders.find({}, projection, batch_size=batch_size):
+            for field in ORDER_FIELDS:
+                columns[field].append(order.get(field))
+
+        self.size = len(columns['Sales'])
+        self.order_date = np.array([_date(d) for d in columns['Order Date']], dtype='datetime64[ms]')
+        ship_date = np.array([_date(d) for d in columns['Ship Date']], dtype='datetime64[ms]')
+        # Same day boundaries as $dateDiff with unit day, NaN without a ship date
+        ship_days = ship_date.astype('datetime64[D]') - self.order_date.astype('datetime64[D]')
+        self.ship_days = np.where(np.isnat(ship_days), np.nan, ship_days.astype(np.float64)).astype(np.float32)
+        self.sales = np.array([_number(v) for v in columns['Sales']], dtype=money_dtype)
+        self.profit = np.array([_number(v) for v in columns['Profit']], dtype=money_dtype)
+        self.quantity = np.array([_number(v) for v in columns['Quantity']], dtype=np.int32)
+        self.customer, self.customers = encode(columns['Customer ID'])
+        self.product, self.product_ids = encode(columns['Product ID'])
+        self.segment, self.segments = encode(columns['Segment'])
+        self.ship_mode, self.ship_modes = encode(columns['Ship Mode'])
+
+        # Dimensions joined at load time. A Product ID maps to its first product,
+        # like the products dimension; a Customer ID to every matching document
+        # like the $lookup + $unwind of the pipelines
+        self.products = first_products(db)
+        self.customer_names = {}
+        for customer in db.Customers.find({}, {'_id': 0, 'Customer ID': 1, 'Customer Name': 1}):
+            self.customer_names.setdefault(customer.get('Customer ID'), []).append(customer.get('Customer Name'))
+        self.loaded_at = time.monotonic()
+
+    def lookup(self):
+        # Products map in the ProductDimension format, for the dimensions helpers
+        return self.products
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in (
+            'order_date', 'ship_days', 'sales', 'profit', 'quantity', 'customer', 'product', 'segment', 'ship_mode'
+        ))
+
+    def mask(self, filters):
+        mask = np.ones(self.size, dtype=bool)
+        low, high = filters.date_range()
+        if low:
+            mask &= self.order_date >= np.datetime64(low, 'ms')
+        if high:
+            mask &= self.order_date < np.datetime64(high, 'ms')
+        for value, codes, labels in ((filters.segment, self.segment, self.segments),
+                                     (filters.ship_mode, self.ship_mode, self.ship_modes)):
+            if value:
+                mask &= codes == (labels.index(value) if value in labels else -1)
+        if filters.category:
+            in_category = [code for code, product_id in enumerate(self.product_ids)
+                           if any(p.get('Category') == filters.category for p in self.products.get(product_id, []))]
+            mask &= np.isin(self.product, in_category)
+        return mask
+
+
+def _group(codes, labels, mask, weights=None):
+    """(label, total) of the codes present under the mask, totals in float64."""
+    selected = codes[mask]
+    counts = np.bincount(selected, minlength=len(labels))
+    totals = counts if weights is None else np.bincount(selected, weights=weights[mask].astype(np.float64),
+                                                        minlength=len(labels))
+    return [(labels[code], totals[code]) for code in np.flatnonzero(counts)]
+
+
+def _total(snapshot, mask, column, name):
+    if not mask.any():
+        return []
+    return [{'_id': None, name: float(getattr(snapshot, column)[mask].sum(dtype=np.float64))}]
+
+
+def _by_segment(snapshot, mask, output, column=None):
+    weights = getattr(snapshot, column) if column else None
+    return [{output: _scalar(total), 'Segment': segment}
+            for segment, total in _group(snapshot.segment, snapshot.segments, mask, weights)]
+
+
+def _by_category(snapshot, mask, output, column=None):
+    weights = getattr(snapshot, column) if column else None
+    rows = [{'_id': product_id, output: _scalar(total)}
+            for product_id, total in _group(snapshot.product, snapshot.product_ids, mask, weights)]
+    return by_category(snapshot, rows, [output])
+
+
+def _scalar(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def total_quantity(snapshot, mask):
+    if not mask.any():
+        return []
+    return [{'_id': None, 'totalQuantity': int(snapshot.quantity[mask].sum(dtype=np.int64))}]
+
+
+def total_orders(snapshot, mask):
+    count = int(mask.sum())
+    return [{'Order ID': count}] if count else []
+
+
+def average_sales(snapshot, mask):
+    count = int(mask.sum())
+    if not count:
+        return []
+    return [{'averageSalesPerOrder': float(snapshot.sales[mask].sum(dtype=np.float64)) / count}]
+
+
+def customer_orders(snapshot, mask):
+    counts = np.bincount(snapshot.customer[mask], minlength=len(snapshot.customers))
+    return counts[counts > 0]
+
+
+def total_client(snapshot, mask):
+    customers = customer_orders(snapshot, mask).size
+    return [{'Customers ID': customers}] if customers else []
+
+
+def average_orders_by_customers(snapshot, mask):
+    counts = customer_orders(snapshot, mask)
+    return [{'_id': None, 'averageOrdersPerCustomer': float(counts.mean())}] if counts.size else []
+
+
+def kpis(snapshot, mask):
+    counts = customer_orders(snapshot, mask)
+    if not counts.size:
+        return []
+    return [{
+        'totalSales': float(snapshot.sales[mask].sum(dtype=np.float64)),
+        'totalProfit': float(snapshot.profit[mask].sum(dtype=np.float64)),
+        'totalOrders': int(mask.sum()),
+        'totalQuantity': int(snapshot.quantity[mask].sum(dtype=np.int64)),
+        'totalClients': int(counts.size),
+        'averageOrdersPerCustomer': float(counts.mean())
+    }]
+
+
+
+def kpis_by_year(snapshot, mask):
+    dated = mask & ~np.isnat(snapshot.order_date)
+    years = snapshot.order_date.astype('datetime64[Y]').astype(np.int64) + 1970
+    return [dict(row, year=int(year))
+            for year in np.unique(years[dated])
+            for row in kpis(snapshot, dated & (years == year))]
+
+def ship_mode(snapshot, mask):
+    rows = [{'_id': mode, 'totalOrders': int(count)}
+            for mode, count in _group(snapshot.ship_mode, snapshot.ship_modes, mask)]
+    return sorted(rows, key=lambda row: row['totalOrders'])
+
+
+def average_per_ship_mode(snapshot, mask):
+    shipped = mask & ~np.isnan(snapshot.ship_days)
+    days = dict(_group(snapshot.ship_mode, snapshot.ship_modes, shipped, snapshot.ship_days))
+    counts = dict(_group(snapshot.ship_mode, snapshot.ship_modes, shipped))
+    return [{'_id': mode, 'AverageDaysDifference': round(days[mode] / counts[mode], 1) if mode in counts else None}
+            for mode, _ in _group(snapshot.ship_mode, snapshot.ship_modes, mask)]
+
+
+def category_by_segment(snapshot, mask):
+    pairs = snapshot.segment[mask].astype(np.int64) * len(snapshot.product_ids) + snapshot.product[mask]
+    codes, counts = np.unique(pairs, return_counts=True)
+    rows = [{'_id': {'Segment': snapshot.segments[code // len(snapshot.product_ids)],
+                     'Product ID': snapshot.product_ids[code % len(snapshot.product_ids)]},
+             'TotalOrders': int(count)}
+            for code, count in zip(codes, counts)]
+    return top_category_by_segment(snapshot, rows)
+
+
+def retention_by_customers(snapshot, mask):
+    dated = mask & ~np.isnat(snapshot.order_date)
+    dates = snapshot.order_date.astype(np.int64)
+    size = len(snapshot.customers)
+    first = np.full(size, np.iinfo(np.int64).max)
+    last = np.full(size, np.iinfo(np.int64).min)
+    np.minimum.at(first, snapshot.customer[dated], dates[dated])
+    np.maximum.at(last, snapshot.customer[dated], dates[dated])
+    counts = np.bincount(snapshot.customer[mask], minlength=size)
+    by_name = {}
+    for code in np.flatnonzero(counts):
+        for name in snapshot.customer_names.get(snapshot.customers[code], []):
+            row = by_name.setdefault(name, [first[code], last[code], 0])
+            row[0], row[1], row[2] = min(row[0], first[code]), max(row[1], last[code]), row[2] + counts[code]
+    rows = []
+    for name, (first_ms, last_ms, count) in by_name.items():
+        if count <= 1:
+            continue
+        dated_customer = first_ms <= last_ms
+        rows.append({
+            '_id': name,
+            'firstOrderDate': np.datetime64(int(first_ms), 'ms').item() if dated_customer else None,
+            'lastOrderDate': np.datetime64(int(last_ms), 'ms').item() if dated_customer else None,
+            'orderCount': int(count),
+            'Customer Name': name,
+            'retentionPeriodDays': int(last_ms - first_ms) / (1000 * 60 * 60 * 24) if dated_customer else None
+        })
+    return rows
+
+
+# Columnar implementation of each endpoint of main.py: (snapshot, mask) -> documents
+QUERIES = {
+    'total_sales': lambda s, m: _total(s, m, 'sales', 'totalSales'),
+    'total_profits': lambda s, m: _total(s, m, 'profit', 'totalProfit'),
+    'total_orders': total_orders,
+    'average_sales': average_sales,
+    'total_quantity': total_quantity,
+    'total_client': total_client,
+    'kpis': kpis,
+    'kpis_by_year': kpis_by_year,
+    'ship_mode': ship_mode,
+    'average_per_ship_mode': average_per_ship_mode,
+    'quantity_by_category': lambda s, m: _by_category(s, m, 'totalQuantity', 'quantity'),
+    'total_orders_by_category': lambda s, m: _by_category(s, m, 'totalOrders'),
+    'revenue_by_category': lambda s, m: _by_category(s, m, 'totalSales', 'sales'),
+    'category_by_segment': category_by_segment,
+    'total_orders_by_segment': lambda s, m: _by_segment(s, m, 'TotalOrders'),
+    'revenue_by_segment': lambda s, m: _by_segment(s, m, 'totalRevenue', 'sales'),
+    'average_orders_by_customers': average_orders_by_customers,
+    'retention_by_customers': retention_by_customers
+}
+
+
+class ColumnarEngine:
+    """Holds the current snapshot and rebuilds it in the background when the
+    data version changes or the snapshot is older than `max_age` seconds.
+
+    Queries keep using the previous snapshot while a rebuild runs; only the
+    very first query waits for a load.
+    """
+
+    def __init__(self, db, version=None, version_interval=5.0, max_age=3600, money_dtype=np.float32):
+        self.db = db
+        self.version = version
+        self.version_interval = version_interval
+        self.max_age = max_age
+        self.money_dtype = money_dtype
+        self.snapshot = None
+        self.snapshot_version = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def build(self):
+        try:
+            version = self.version() if self.version else None
+            snapshot = ColumnarSnapshot(self.db, self.money_dtype)
+            with self.lock:
+                self.snapshot, self.snapshot_version = snapshot, version
+        finally:
+            # A failed build is retried at the next version check
+            with self.lock:
+                self.refreshing = False
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        except Exception:
+            columnar_log.exception("Columnar snapshot build failed")
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._build_in_background, daemon=True).start()
+
+    def current(self):
+        if self.snapshot is None:
+            with self.lock:
+                self.refreshing = True
+            self.build()
+            self.checked_at = time.monotonic()
+        elif time.monotonic() - self.checked_at >= self.version_interval:
+            self.checked_at = time.monotonic()
+            stale = time.monotonic() - self.snapshot.loaded_at > self.max_age
+            if stale or (self.version and self.version() != self.snapshot_version):
+                self.refresh_in_background()
+        return self.snapshot
+
+    def query(self, endpoint, filters):
+        snapshot = self.current()
+        return QUERIES[endpoint](snapshot, snapshot.mask(filters))
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            'loaded': snapshot is not None,
+            'orders': snapshot.size if snapshot else 0,
+            'bytes': snapshot.nbytes() if snapshot else 0,
+            'ageSeconds': round(time.monotonic() - snapshot.loaded_at, 1) if snapshot else None,
+            'dataVersion': self.snapshot_version,
+            'refreshing': self.refreshing
+        }
+
+
+def _close(a, b, tolerance):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_close(a[k], b[k], tolerance) for k in a)
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=tolerance, abs_tol=tolerance)
+    return a == b
+
+
+def _key(row):
+    return repr(sorted((k, v) for k, v in row.items() if not isinstance(v, float)))
+
+
+def parity_failures(fetch, params_list, tolerance=1e-4):
+    """Compare every columnar endpoint with its Orders pipeline; `fetch(endpoint,
+    params)` returns the JSON answer of the API."""
+    failures = []
+    for endpoint in QUERIES:
+        for params in params_list:
+            expected = fetch(endpoint, dict(params, exact=True))
+            actual = fetch(endpoint, dict(params, source='columnar'))
+            if isinstance(expected, dict):
+                expected, actual = [expected], [actual]
+            expected, actual = sorted(expected, key=_key), sorted(actual, key=_key)
+            ok = len(expected) == len(actual) and all(_close(e, a, tolerance) for e, a in zip(expected, actual))
+            print(f"{'OK  ' if ok else 'FAIL'} {endpoint} {params}")
+            if not ok:
+                failures.append((endpoint, params))
+    return failures
+
+
+def check_parity(api_url, params_list, tolerance=1e-4):
+    """Compare every columnar endpoint with its Orders pipeline through the API."""
+    import requests
+
+    def fetch(endpoint, params):
+        return requests.get(f"{api_url}/{endpoint}", params=params, timeout=300).json()
+
+    return parity_failures(fetch, params_list, tolerance)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity check of the columnar engine against the Orders pipelines")
+    parser.add_argument("--check", metavar="API_URL", default="http://localhost:8000")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Relative tolerance of float32 sums")
+    args = parser.parse_args()
+    import requests
+    years = requests.get(f"{args.check}/years", timeout=60).json()
+    failures = check_parity(args.check, [{}] + [{'year': year} for year in years], args.tolerance)
+    raise SystemExit(1 if failures else 0)
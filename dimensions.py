@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+# $lookup stage giving an order the Category of a single product document of
+# its Product ID, the first inserted, so that a Product ID duplicated in
+# Products never counts an order twice
+CATEGORY_LOOKUP = {'$lookup': {
+    'from': 'Products',
+    'localField': 'Product ID',
+    'foreignField': 'Product ID',
+    'pipeline': [{'$sort': {'_id': 1}}, {'$limit': 1}, {'$project': {'_id': 0, 'Category': 1}}],
+    'as': 'ProductDetails'
+}}
+
+
+def first_products(db):
+    """Product ID -> [product] map holding the first product document of each
+    Product ID, in `_id` order: the one CATEGORY_LOOKUP joins. The list format
+    is the one the helpers below read."""
+    products = {}
+    cursor = db.Products.find({}, {'_id': 0, 'Product ID': 1, 'Category': 1, 'Sub-Category': 1}, sort=[('_id', 1)])
+    for product in cursor:
+        products.setdefault(product.get('Product ID'), [product])
+    return products
+
+
+class ProductDimension:
+    """In-memory Product ID -> product attributes map, reloaded when Products changes.
+
+    `version` is a callable returning the data version bumped by the writers of
+    Products (see cache.py), e.g. the one the result cache last saw. It is
+    checked on every lookup by default, so that a result recomputed after an
+    invalidation never folds with stale products; `version_interval` throttles
+    it. A Product ID maps to its first product only, like CATEGORY_LOOKUP in the
+    rollup cube, so a duplicated ID never counts an order twice.
+    """
+
+    def __init__(self, db, version=None, version_interval=0.0):
+        self.db = db
+        self.version = version
+        self.version_interval = version_interval
+        self.loaded_version = None
+        self.checked_at = 0.0
+        self.products = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        return first_products(self.db)
+
+    def lookup(self):
+        with self.lock:
+            if self.products is None or time.monotonic() - self.checked_at >= self.version_interval:
+                version = self.version() if self.version else None
+                if self.products is None or version != self.loaded_version:
+                    self.products = self.load()
+                    self.loaded_version = version
+                self.checked_at = time.monotonic()
+            return self.products
+
+    def product_ids(self, value, attribute='Category'):
+        return [
+            product_id for product_id, products in self.lookup().items()
+            if any(product.get(attribute) == value for product in products)
+        ]
+
+
+def _attribute(products, product_id, attribute='Category'):
+    return [product.get(attribute) for product in products.get(product_id, [])]
+
+
+def by_category(dimension, rows, fields, attribute='Category'):
+    """Fold rows grouped by Product ID into totals per product category."""
+    products = dimension.lookup()
+    totals = {}
+    for row in rows:
+        for category in _attribute(products, row['_id'], attribute):
+            total = totals.setdefault(category, dict.fromkeys(fields, 0))
+            for field in fields:
+                total[field] += row[field]
+    return [dict(total, **{attribute: category}) for category, total in totals.items()]
+
+
+def top_category_by_segment(dimension, rows):
+    """Most ordered category of each segment, from rows grouped by Segment x Product ID."""
+    products = dimension.lookup()
+    orders = {}
+    for row in rows:
+        segment = row['_id'].get('Segment')
+        for category in _attribute(products, row['_id'].get('Product ID')):
+            counts = orders.setdefault(segment, {})
+            counts[category] = counts.get(category, 0) + row['TotalOrders']
+    return [
+        {'TopCategory': max(counts, key=counts.get), 'Segment': segment}
+        for segment, counts in orders.items()
+    ]
@@ -0,0 +1,170 @@
+import argparse
+import functools
+import gzip
+import json
+import time
+from contextvars import ContextVar
+from datetime import date
+
+from fastapi import Response
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+from metrics import SERIALIZATION_SECONDS, observe, request_labels
+
+# Optional encoders: orjson for JSON, pyarrow for the columnar format, brotli
+# for compression. Without them responses fall back to json and gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MEDIA_TYPE = 'application/json'
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+# Bodies smaller than this are not worth compressing
+MINIMUM_COMPRESSED_SIZE = 1024
+
+# Accept and Accept-Encoding headers of the request being answered
+request_headers = ContextVar('request_headers', default={})
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def encode_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def encode_arrow(content):
+    """Arrow IPC stream of a list of documents, None when it is not tabular."""
+    rows = [content] if isinstance(content, dict) else content
+    if pa is None or not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return None
+    try:
+        table = pa.Table.from_pylist(rows)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _accepts(header, token):
+    return any(part.split(';')[0].strip() == token for part in header.split(','))
+
+
+class NegotiatedResponse(Response):
+    """Response encoded after the Accept header: Arrow IPC when asked for and
+    the content is tabular, orjson otherwise. Large bodies are compressed
+    with brotli or gzip after Accept-Encoding."""
+
+    media_type = JSON_MEDIA_TYPE
+
+    def __init__(self, content, status_code=200, headers=None, **kwargs):
+        start = time.perf_counter()
+        headers = dict(headers or {})
+        accepted = request_headers.get()
+        if isinstance(content, BaseModel):
+            content = content.model_dump()
+        body = None
+        if _accepts(accepted.get('accept', ''), ARROW_MEDIA_TYPE):
+            body = encode_arrow(content)
+        media_type = ARROW_MEDIA_TYPE if body is not None else JSON_MEDIA_TYPE
+        if body is None:
+            body = encode_json(content)
+        encodings = accepted.get('accept-encoding', '')
+        if len(body) >= MINIMUM_COMPRESSED_SIZE:
+            if brotli is not None and _accepts(encodings, 'br'):
+                body, headers['Content-Encoding'] = brotli.compress(body, quality=4), 'br'
+            elif _accepts(encodings, 'gzip'):
+                body, headers['Content-Encoding'] = gzip.compress(body, compresslevel=5), 'gzip'
+        headers['Vary'] = 'Accept, Accept-Encoding'
+        observe(SERIALIZATION_SECONDS, time.perf_counter() - start, format='arrow' if media_type == ARROW_MEDIA_TYPE else 'json')
+        super().__init__(body, status_code=status_code, headers=headers, media_type=media_type)
+
+
+class NegotiatedRoute(APIRoute):
+    """Route whose endpoint results are sent as a NegotiatedResponse, which
+    skips FastAPI's jsonable_encoder pass over the result."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def negotiated(*args, **kwargs):
+            result = await endpoint(*args, **kwargs)
+            if isinstance(result, Response):
+                return result
+            response = NegotiatedResponse(result)
+            # FastAPI only merges the headers and status set on an injected
+            # Response parameter into the responses it builds itself
+            for value in kwargs.values():
+                if isinstance(value, Response):
+                    response.headers.raw.extend(value.headers.raw)
+                    if value.status_code:
+                        response.status_code = value.status_code
+            return response
+
+        super().__init__(path, negotiated, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request):
+            # Metrics are labelled with the route template rather than the path
+            labels = request_labels.get()
+            if labels is not None:
+                labels['endpoint'] = self.path
+            token = request_headers.set({
+                'accept': request.headers.get('accept', ''),
+                'accept-encoding': request.headers.get('accept-encoding', '')
+            })
+            try:
+                return await handler(request)
+            finally:
+                request_headers.reset(token)
+
+        return route_handler
+
+
+def check_pagination(api_url, endpoint='retention_by_customers', limit=3):
+    """Check through the API that the X-Next-Cursor header of a page survives
+    JSON and Arrow negotiation and revalidation with a 304."""
+    import requests
+    failures = []
+    for accept in (JSON_MEDIA_TYPE, ARROW_MEDIA_TYPE):
+        headers = {'Accept': accept}
+        page = requests.get(f"{api_url}/{endpoint}", params={'limit': limit}, headers=headers, timeout=300)
+        cursor, etag = page.headers.get('X-Next-Cursor'), page.headers.get('ETag')
+        revalidated = requests.get(f"{api_url}/{endpoint}", params={'limit': limit},
+                                   headers=dict(headers, **{'If-None-Match': etag or ''}), timeout=300)
+        checks = {
+            'cursor': page.status_code == 200 and cursor is not None,
+            '304': revalidated.status_code == 304 and revalidated.headers.get('X-Next-Cursor') == cursor
+        }
+        for name, ok in checks.items():
+            print(f"{'OK  ' if ok else 'FAIL'} {endpoint} {accept} {name}")
+            if not ok:
+                failures.append((accept, name))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the headers of paginated responses across encodings")
+    parser.add_argument("--check", metavar="API_URL", default="http://localhost:8000")
+    args = parser.parse_args()
+    raise SystemExit(1 if check_pagination(args.check) else 0)
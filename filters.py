@@ -0,0 +1,98 @@
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException, Query
+from pydantic import BaseModel
+
+
+# Latest year and end day whose half-open range still ends within datetime
+MAX_YEAR = 9998
+MAX_END = date(9999, 12, 30)
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return datetime(day.year + month // 12, month % 12 + 1, 1)
+
+
+class OrderFilters(BaseModel):
+    """Time window and dimension predicates shared by the KPI endpoints."""
+    year: Optional[int] = None
+    quarter: Optional[int] = None
+    month: Optional[int] = None
+    start: Optional[date] = None
+    end: Optional[date] = None
+    segment: Optional[str] = None
+    category: Optional[str] = None
+    ship_mode: Optional[str] = None
+
+    def date_range(self):
+        """Half-open [low, high) datetime range selected by the filters, None for unbounded."""
+        low = high = None
+        if self.year:
+            low, high = datetime(self.year, 1, 1), datetime(self.year + 1, 1, 1)
+            if self.quarter:
+                low = datetime(self.year, 3 * (self.quarter - 1) + 1, 1)
+                high = _add_months(low, 3)
+            if self.month:
+                low = datetime(self.year, self.month, 1)
+                high = _add_months(low, 1)
+        if self.start:
+            start = datetime(self.start.year, self.start.month, self.start.day)
+            low = max(low, start) if low else start
+        if self.end:
+            end = datetime(self.end.year, self.end.month, self.end.day) + timedelta(days=1)
+            high = min(high, end) if high else end
+        return low, high
+
+    def match(self, date_field='Order Date', category=None):
+        """`$match` predicate of the filters, or None when nothing is filtered.
+
+        `category` turns the category name into a predicate, since Orders only
+        reference their product; it defaults to an equality on `Category`.
+        """
+        predicate = {}
+        low, high = self.date_range()
+        if low or high:
+            predicate[date_field] = {}
+            if low:
+                predicate[date_field]['$gte'] = low
+            if high:
+                predicate[date_field]['$lt'] = high
+        if self.segment:
+            predicate['Segment'] = self.segment
+        if self.ship_mode:
+            predicate['Ship Mode'] = self.ship_mode
+        if self.category:
+            predicate.update(category(self.category) if category else {'Category': self.category})
+        return predicate or None
+
+
+def filter_orders(pipeline, filters, date_field='Order Date', category=None):
+    """Put the filters first in the pipeline, where the `$match` can use the indexes."""
+    predicate = filters.match(date_field, category) if filters else None
+    if predicate:
+        pipeline.insert(0, {'$match': predicate})
+    return pipeline
+
+
+def order_filters(
+    year: int = Query(None, ge=1, le=MAX_YEAR),
+    quarter: int = Query(None, ge=1, le=4),
+    month: int = Query(None, ge=1, le=12),
+    start: date = Query(None, description="First day included"),
+    end: date = Query(None, le=MAX_END, description="Last day included"),
+    segment: str = Query(None),
+    category: str = Query(None),
+    ship_mode: str = Query(None)
+):
+    if (quarter or month) and not year:
+        raise HTTPException(status_code=422, detail="quarter and month filters need a year")
+    if quarter and month:
+        raise HTTPException(status_code=422, detail="Use either a quarter or a month filter")
+    if start and end and start > end:
+        raise HTTPException(status_code=422, detail="start must not be after end")
+    return OrderFilters(
+        year=year, quarter=quarter, month=month, start=start, end=end,
+        segment=segment, category=category, ship_mode=ship_mode
+    )
@@ -0,0 +1,117 @@
+import argparse
+import os
+
+from pymongo import ASCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+
+# Indexes of each collection, shaped to the pipelines of main.py. The Orders
+# ones but the lead time one start with `Order Date` so that the year `$match`
+# is an index range scan, and carry the fields the following `$group` reads,
+# so that filtered pipelines can be answered from the index alone
+INDEXES = {
+    'Orders': [
+        # total_* KPIs, /kpis, total_client, average_orders_by_customers
+        IndexModel(
+            [('Order Date', ASCENDING), ('Customer ID', ASCENDING), ('Sales', ASCENDING),
+             ('Profit', ASCENDING), ('Quantity', ASCENDING)],
+            name='order_date_totals'
+        ),
+        # Segment, Ship Mode and product breakdowns
+        IndexModel(
+            [('Order Date', ASCENDING), ('Segment', ASCENDING), ('Ship Mode', ASCENDING),
+             ('Product ID', ASCENDING), ('Sales', ASCENDING), ('Quantity', ASCENDING)],
+            name='order_date_breakdowns'
+        ),
+        # average_per_ship_mode
+        IndexModel(
+            [('Order Date', ASCENDING), ('Ship Mode', ASCENDING), ('Ship Date', ASCENDING)],
+            name='order_date_shipping'
+        ),
+        # Lead time endpoints, which all match on the lead time first
+        IndexModel(
+            [('Lead Time', ASCENDING), ('Ship Mode', ASCENDING), ('Segment', ASCENDING), ('Order Date', ASCENDING)],
+            name='lead_time'
+        )
+    ],
+    # foreignField of the $lookup into Products and the products dimension
+    'Products': [
+        IndexModel([('Product ID', ASCENDING), ('Category', ASCENDING), ('Sub-Category', ASCENDING)],
+                   name='product_id_category')
+    ],
+    # foreignField of the $lookup into Customers
+    'Customers': [
+        IndexModel([('Customer ID', ASCENDING)], name='customer_id')
+    ],
+    'OrdersDaily': [
+        IndexModel([('day', ASCENDING)], name='day')
+    ],
+    'CustomerSketches': [
+        IndexModel([('day', ASCENDING), ('Segment', ASCENDING)], name='day_segment')
+    ],
+    'ValueSketches': [
+        IndexModel([('day', ASCENDING), ('Segment', ASCENDING), ('Category', ASCENDING)], name='day_segment_category')
+    ],
+    # Upsert key of the $inc updates and lookup key of the reads
+    'RunningTotals': [
+        IndexModel([('year', ASCENDING), ('by', ASCENDING), ('value', ASCENDING)], name='year_by_value', unique=True)
+    ]
+}
+
+
+def ensure_indexes(db, spec=None):
+    """Create the missing indexes of the spec; existing identical ones are left untouched.
+
+    Returns the names of the indexes per collection and the conflicts met, e.g.
+    an index with the same keys already created under another name.
+    """
+    created, errors = {}, {}
+    for collection, models in (spec or INDEXES).items():
+        try:
+            created[collection] = db[collection].create_indexes(models)
+        except OperationFailure as e:
+            errors[collection] = str(e)
+    return created, errors
+
+
+def _index_names(plan):
+    if isinstance(plan, dict):
+        names = {plan['indexName']} if 'indexName' in plan else set()
+        for value in plan.values():
+            names |= _index_names(value)
+        return names
+    if isinstance(plan, list):
+        return set().union(*map(_index_names, plan)) if plan else set()
+    return set()
+
+
+def explain_summary(explain):
+    """Winning plan, documents examined vs. returned and execution time of an
+    `explain` of an aggregation in executionStats verbosity."""
+    stages = explain.get('stages', [])
+    cursor = stages[0].get('$cursor', explain) if stages else explain
+    winning_plan = cursor.get('queryPlanner', {}).get('winningPlan', {})
+    # Slot based engine plans nest the readable plan next to the SBE tree
+    winning_plan = winning_plan.get('queryPlan', winning_plan)
+    stats = cursor.get('executionStats', {})
+    returned = stages[-1].get('nReturned', stats.get('nReturned')) if stages else stats.get('nReturned')
+    return {
+        'winningPlan': winning_plan,
+        'indexesUsed': sorted(_index_names(winning_plan)),
+        'keysExamined': stats.get('totalKeysExamined'),
+        'docsExamined': stats.get('totalDocsExamined'),
+        'queryReturned': stats.get('nReturned'),
+        'docsReturned': returned,
+        'executionTimeMillis': stats.get('executionTimeMillis')
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the indexes of the API collections")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    created, errors = ensure_indexes(MongoClient(args.mongo_url)[args.database])
+    for collection, names in created.items():
+        print(f"{collection}: {', '.join(names)}")
+    for collection, error in errors.items():
+        print(f"{collection}: {error}")
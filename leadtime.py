@@ -0,0 +1,143 @@
+"""Shipping lead time of the orders, materialized as the integer `Lead Time`
+field of Orders (days from `Order Date` to `Ship Date`), and the histograms,
+percentiles and SLA breaches read from it.
+
+The field is set when orders are written: by POST /orders, loader.py and
+synthetic.py. Orders written otherwise get it from the backfill:
+
+    python leadtime.py
+    python leadtime.py --all    # recompute it everywhere, e.g. after Ship Date edits
+"""
+import argparse
+import os
+from datetime import datetime
+
+from pymongo import MongoClient
+
+from cache import bump_data_version
+
+LEAD_TIME = 'Lead Time'
+
+# Lead time promised by each ship mode, in days; a longer one is an SLA breach
+SLA_DAYS = {'Same Day': 0, 'First Class': 2, 'Second Class': 3, 'Standard Class': 5}
+
+# Fields of the groups of the lead time endpoints, by query parameter value
+GROUPS = {'ship_mode': 'Ship Mode', 'segment': 'Segment'}
+
+LEAD_TIME_EXPRESSION = {'$dateDiff': {'startDate': '$Order Date', 'endDate': '$Ship Date', 'unit': 'day'}}
+
+
+def lead_time(order_date, ship_date):
+    """Day boundaries crossed between the two dates, like $dateDiff with unit
+    day; None unless both are datetimes."""
+    if isinstance(order_date, datetime) and isinstance(ship_date, datetime):
+        return (ship_date.date() - order_date.date()).days
+    return None
+
+
+def with_lead_time(order):
+    """The order with its `Lead Time`, when it is shipped."""
+    days = lead_time(order.get('Order Date'), order.get('Ship Date'))
+    if days is not None:
+        order[LEAD_TIME] = days
+    return order
+
+
+def backfill_lead_times(db, recompute=False):
+    """Set `Lead Time` on the shipped orders missing it, or on all of them
+    with `recompute`. Returns the number of orders updated."""
+    shipped = {'Order Date': {'$type': 'date'}, 'Ship Date': {'$type': 'date'}}
+    if not recompute:
+        shipped[LEAD_TIME] = {'$exists': False}
+    result = db.Orders.update_many(shipped, [{'$set': {LEAD_TIME: LEAD_TIME_EXPRESSION}}])
+    if result.modified_count:
+        bump_data_version(db)
+    return result.modified_count
+
+
+def lead_time_pipeline():
+    """Orders per ship mode x segment x lead time. The leading $match on the
+    integer field bounds the scan of the lead time index, which covers the
+    pipeline."""
+    return [
+        {'$match': {LEAD_TIME: {'$type': 'number'}}},
+        {'$group': {
+            '_id': {'Ship Mode': '$Ship Mode', 'Segment': '$Segment', 'days': f'${LEAD_TIME}'},
+            'orders': {'$sum': 1}
+        }}
+    ]
+
+
+def _counts(rows, fields):
+    """Orders per group of `fields` and lead time: {group: {days: orders}}."""
+    counts = {}
+    for row in rows:
+        group = tuple(row['_id'].get(field) for field in fields)
+        days = counts.setdefault(group, {})
+        days[row['_id']['days']] = days.get(row['_id']['days'], 0) + row['orders']
+    return counts
+
+
+def _group_row(fields, group):
+    return dict(zip(fields, group))
+
+
+def histogram(rows, fields):
+    """One row per group and lead time, in lead time order."""
+    return [
+        dict(_group_row(fields, group), days=days, orders=orders)
+        for group, counts in sorted(_counts(rows, fields).items(), key=lambda item: str(item[0]))
+        for days, orders in sorted(counts.items())
+    ]
+
+
+def _percentile(counts, total, rank):
+    # Nearest rank: the smallest lead time reached by rank % of the orders
+    needed = max(1, -(-rank * total // 100))
+    reached = 0
+    for days, orders in sorted(counts.items()):
+        reached += orders
+        if reached >= needed:
+            return days
+    return None
+
+
+def percentiles(rows, fields, ranks):
+    """Exact percentiles of the lead time of each group, with its mean."""
+    result = []
+    for group, counts in sorted(_counts(rows, fields).items(), key=lambda item: str(item[0])):
+        total = sum(counts.values())
+        row = dict(_group_row(fields, group), orders=total,
+                   averageDays=sum(days * orders for days, orders in counts.items()) / total)
+        row.update({f"p{rank:g}": _percentile(counts, total, rank) for rank in ranks})
+        result.append(row)
+    return result
+
+
+def sla_breaches(rows, fields, days=None):
+    """Orders shipped later than the SLA of their ship mode, or than `days`
+    for all of them, per group. Ship modes without an SLA are left out."""
+    totals = {}
+    for row in rows:
+        target = days if days is not None else SLA_DAYS.get(row['_id'].get('Ship Mode'))
+        if target is None:
+            continue
+        group = tuple(row['_id'].get(field) for field in fields)
+        total = totals.setdefault(group, {'orders': 0, 'breaches': 0})
+        total['orders'] += row['orders']
+        if row['_id']['days'] > target:
+            total['breaches'] += row['orders']
+    return [
+        dict(_group_row(fields, group), **total, breachRate=total['breaches'] / total['orders'])
+        for group, total in sorted(totals.items(), key=lambda item: str(item[0]))
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize the lead time of the orders")
+    parser.add_argument("--all", action="store_true", help="Recompute the lead time of every order")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    db = MongoClient(args.mongo_url)[args.database]
+    print(f"{backfill_lead_times(db, args.all)} order(s) updated")
@@ -0,0 +1,243 @@
+"""Streaming loader of Superstore-style CSV or Parquet exports into the Orders,
+Products and Customers collections.
+
+The file is read batch by batch, so memory stays bounded whatever its size:
+at most `workers * 2` batches are parsed and waiting to be written. Each
+batch is written by a pool of workers with unordered inserts, in whatever
+order the batches finish. `Order Date` and `Ship Date` are stored as real
+datetimes. Product and customer attributes go to their own collections, one
+document per Product ID or Customer ID.
+
+Loads are resumable: every order gets an `_id` derived from the file and its
+row number, and the batches written are recorded in LoadState, so running the
+same command again after an interruption skips the finished batches and
+ignores the orders of the unfinished ones that were already inserted.
+
+    python loader.py Superstore.csv --encoding latin-1
+    python loader.py orders.parquet --batch-size 20000 --workers 8 --refresh
+"""
+import argparse
+import csv
+import functools
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timezone
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cache import bump_data_version
+from leadtime import with_lead_time
+
+# Optional reader of Parquet files
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# First rows of the batches written to Orders, one document per file being loaded
+STATE_COLLECTION = 'LoadState'
+DUPLICATE_KEY = 11000
+
+PRODUCT_FIELDS = ('Product ID', 'Category', 'Sub-Category', 'Product Name')
+CUSTOMER_FIELDS = ('Customer ID', 'Customer Name', 'Segment')
+# Attributes read through the dimensions rather than from Orders
+DIMENSION_ONLY = {'Category', 'Sub-Category', 'Product Name', 'Customer Name'}
+DATE_FIELDS = ('Order Date', 'Ship Date')
+# Postal codes stay strings, some start with a zero
+NUMERIC_FIELDS = {'Sales': float, 'Profit': float, 'Discount': float, 'Quantity': int, 'Row ID': int}
+# Superstore exports write dates as month/day/year
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S')
+
+
+def file_key(path):
+    """Identity of a file across runs: its name, size and first megabyte."""
+    digest = hashlib.sha1(f"{os.path.basename(path)}:{os.path.getsize(path)}".encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(1 << 20))
+    return digest.hexdigest()[:16]
+
+
+def read_csv(path, batch_size, encoding='utf-8-sig'):
+    with open(path, newline='', encoding=encoding) as f:
+        batch = []
+        for row in csv.DictReader(f):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def read_parquet(path, batch_size):
+    if pq is None:
+        raise RuntimeError("pyarrow is required to read Parquet files")
+    for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        yield record_batch.to_pylist()
+
+
+def read_batches(path, batch_size, encoding='utf-8-sig'):
+    if path.lower().endswith(('.parquet', '.pq')):
+        return read_parquet(path, batch_size)
+    return read_csv(path, batch_size, encoding)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_date(value, formats=DATE_FORMATS):
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(value)
+
+
+def clean(row, date_formats=DATE_FORMATS):
+    """Typed copy of a row: datetimes for the dates, numbers for the measures,
+    blank cells dropped. Values already typed, e.g. by Parquet, are kept."""
+    doc = {}
+    for field, value in row.items():
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        if field in DATE_FIELDS:
+            if isinstance(value, str):
+                value = parse_date(value.strip(), date_formats)
+            elif isinstance(value, date) and not isinstance(value, datetime):
+                value = datetime(value.year, value.month, value.day)
+        elif field in NUMERIC_FIELDS and isinstance(value, str):
+            try:
+                value = NUMERIC_FIELDS[field](value.replace(',', ''))
+            except ValueError:
+                pass
+        doc[field] = value
+    return doc
+
+
+def dimension_rows(docs, fields, seen):
+    """Rows of the IDs (the first field) of a dimension not met before in this
+    load, with the attributes of their first order; `seen` is updated."""
+    rows = []
+    for doc in docs:
+        key = doc.get(fields[0])
+        if key is None or key in seen:
+            continue
+        seen.add(key)
+        rows.append({field: doc[field] for field in fields if doc.get(field) is not None})
+    return rows
+
+
+def upsert_dimension(collection, rows, key):
+    # One document per ID: Superstore reuses Product IDs with other names, and
+    # a second document would count their orders twice in every join. The
+    # attributes of an ID already stored are kept
+    if rows:
+        collection.bulk_write([
+            UpdateOne({key: row[key]}, {'$setOnInsert': {field: value for field, value in row.items() if field != key}},
+                      upsert=True)
+            for row in rows
+        ], ordered=False)
+
+
+def insert_orders(collection, orders):
+    """Insert unordered; orders already inserted by an interrupted run are skipped.
+    Returns the number of new orders."""
+    try:
+        return len(collection.insert_many(orders, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        errors = e.details['writeErrors']
+        if any(error['code'] != DUPLICATE_KEY for error in errors):
+            raise
+        return e.details['nInserted']
+
+
+def load(db, path, batch_size=10_000, workers=4, encoding='utf-8-sig', date_formats=DATE_FORMATS,
+         restart=False, progress=print):
+    """Load the orders of a CSV or Parquet file and their products and customers into `db`."""
+    key = file_key(path)
+    state = db[STATE_COLLECTION]
+    if restart:
+        state.delete_one({'_id': key})
+    done = set((state.find_one({'_id': key}) or {}).get('batches', []))
+    state.update_one({'_id': key}, {'$set': {'file': os.path.abspath(path)}}, upsert=True)
+
+    seen_products, seen_customers = set(), set()
+    totals = {'rows': 0, 'inserted': 0, 'skippedBatches': 0, 'products': 0, 'customers': 0}
+
+    def write(first_row, docs, products, customers):
+        upsert_dimension(db.Products, products, PRODUCT_FIELDS[0])
+        upsert_dimension(db.Customers, customers, CUSTOMER_FIELDS[0])
+        orders = [
+            with_lead_time(dict({field: value for field, value in doc.items() if field not in DIMENSION_ONLY},
+                                _id=f"{key}:{first_row + i}"))
+            for i, doc in enumerate(docs)
+        ]
+        inserted = insert_orders(db.Orders, orders)
+        state.update_one({'_id': key}, {'$addToSet': {'batches': first_row}})
+        return len(docs), inserted, len(products), len(customers)
+
+    def collect(finished):
+        for future in finished:
+            rows, inserted, products, customers = future.result()
+            totals['rows'] += rows
+            totals['inserted'] += inserted
+            totals['products'] += products
+            totals['customers'] += customers
+        elapsed = time.perf_counter() - start
+        progress(f"{totals['rows']} rows, {totals['inserted']} new orders ({totals['rows'] / elapsed:.0f} rows/s)")
+
+    start = time.perf_counter()
+    pending, next_row, submitted = set(), 0, False
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            for batch in read_batches(path, batch_size, encoding):
+                first_row, next_row = next_row, next_row + len(batch)
+                if first_row in done:
+                    totals['skippedBatches'] += 1
+                    continue
+                docs = [clean(row, date_formats) for row in batch]
+                # Dimension rows are deduplicated here rather than in the workers,
+                # so that no two workers upsert the same row at once
+                products = dimension_rows(docs, PRODUCT_FIELDS, seen_products)
+                customers = dimension_rows(docs, CUSTOMER_FIELDS, seen_customers)
+                pending.add(pool.submit(write, first_row, docs, products, customers))
+                submitted = True
+                if len(pending) >= workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            if pending:
+                collect(wait(pending)[0])
+    finally:
+        # An interrupted load has written some batches too
+        if submitted:
+            bump_data_version(db)
+
+    state.update_one({'_id': key}, {'$set': {'completedAt': datetime.now(timezone.utc)}})
+    totals['seconds'] = round(time.perf_counter() - start, 3)
+    totals['rowsPerSecond'] = round(totals['rows'] / totals['seconds']) if totals['seconds'] else None
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a Superstore CSV or Parquet file into MongoDB")
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--encoding", default="utf-8-sig", help="Encoding of CSV files, e.g. latin-1")
+    parser.add_argument("--date-format", action="append", help="strptime format of the dates, repeatable")
+    parser.add_argument("--restart", action="store_true", help="Forget the batches of a previous run")
+    parser.add_argument("--refresh", action="store_true", help="Refresh the rollup and running totals after the load")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    db = MongoClient(args.mongo_url)[args.database]
+    formats = tuple(args.date_format) if args.date_format else DATE_FORMATS
+    print(load(db, args.path, args.batch_size, args.workers, args.encoding, formats, args.restart))
+    if args.refresh:
+        from dimensions import ProductDimension
+        from rollup import refresh_rollup
+        from running import rebuild_running_totals
+        refresh_rollup(db)
+        rebuild_running_totals(db, ProductDimension(db).lookup())
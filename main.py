@@ -1,51 +1,445 @@
-from fastapi import FastAPI, Query
-from pymongo import MongoClient
-from datetime import datetime
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.errors import ExecutionTimeout
+from starlette.routing import Match
+from datetime import date, datetime
+import asyncio
+import base64
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+import uuid
 import uvicorn
 
-app = FastAPI()
-client = MongoClient("mongodb://localhost:27017/")
-db = client['ecommerce']
-
-# Helper function to filter by year
-def filter_by_year(pipeline, year):
-    if year:
-        pipeline.insert(0, {
-            '$match': {
-                'Order Date': {
-                    '$gte': datetime(int(year), 1, 1),
-                    '$lt': datetime(int(year) + 1, 1, 1)
-                }
-            }
-        })
-    return pipeline
+import admission
+import columnar
+import leadtime
+import metrics
+import partitioned
+import rollup
+import running
+from cache import CacheWarmer, ResultCache, SingleFlight, data_version
+from dimensions import ProductDimension, by_category, top_category_by_segment
+from encoding import NegotiatedRoute
+from filters import MAX_YEAR, OrderFilters, filter_orders, order_filters
+from indexes import ensure_indexes, explain_summary
+from sketches import VALUE_MEASURES, TDigest, merged_customer_sketch, merged_value_sketches
+from timeseries import CUBE_MEASURES, METRICS, lttb, timeseries_pipeline
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017/")
+MONGO_DB = os.environ.get("MONGO_DB", "ecommerce")
+# "sync" runs the blocking driver on the threadpool, "async" awaits the
+# pipelines on the event loop with the asyncio driver
+MONGO_DRIVER = os.environ.get("MONGO_DRIVER", "sync")
+# Connection pool of each client: enough connections for the concurrent
+# dashboard requests, and bounded waits so that a saturated or unreachable
+# server fails requests instead of piling them up
+MONGO_OPTIONS = {
+    'maxPoolSize': 50,
+    'minPoolSize': 5,
+    'maxIdleTimeMS': 300000,
+    'waitQueueTimeoutMS': 10000,
+    'serverSelectionTimeoutMS': 5000,
+    'connectTimeoutMS': 5000,
+    'socketTimeoutMS': 120000
+}
+
+# Duration and documents returned of every Mongo command, per request and pipeline
+command_metrics = metrics.CommandMetrics()
+client = MongoClient(MONGO_URL, event_listeners=[command_metrics], **MONGO_OPTIONS)
+db = client[MONGO_DB]
+async_client = AsyncMongoClient(MONGO_URL, event_listeners=[command_metrics], **MONGO_OPTIONS) if MONGO_DRIVER == 'async' else None
+async_db = async_client[MONGO_DB] if async_client is not None else None
+
+# Results shared by every request and client of this worker, dropped as soon as
+# the data version is bumped by a writer. CACHE_MAXSIZE=0 disables it. Dropped
+# and expired results are still served for CACHE_STALE_SECONDS while they are
+# recomputed in the background
+result_cache = ResultCache(
+    maxsize=int(os.environ.get("CACHE_MAXSIZE", 256)), ttl=600, version=lambda: data_version(db),
+    stale_ttl=int(os.environ.get("CACHE_STALE_SECONDS", 3600))
+)
+
+# Partitions of the unfiltered Orders aggregations, run concurrently and
+# merged (see partitioned.py). 0 or 1 runs each of them as a single pipeline
+QUERY_PARTITIONS = int(os.environ.get("QUERY_PARTITIONS", 0))
+
+# Pipelines being run, joined by the identical requests arriving meanwhile, e.g.
+# when the dashboard caches of many sessions expire together. CACHE_COALESCE=0
+# runs every request on its own
+in_flight = SingleFlight(coalesce=os.environ.get("CACHE_COALESCE", "1") != "0")
+
+# Product ID -> Category map replacing the per-order $lookup into Products. It
+# follows the data version the result cache saw, so a result cached under a
+# version is never folded with the products of an older one
+products = ProductDimension(db, version=lambda: result_cache.current_version)
+
+# In-memory columnar snapshot of Orders behind source=columnar, reloaded in
+# the background when the data version changes or after COLUMNAR_MAX_AGE seconds
+columnar_engine = columnar.ColumnarEngine(
+    db,
+    version=lambda: data_version(db),
+    max_age=int(os.environ.get("COLUMNAR_MAX_AGE", 3600))
+)
+
+# Indexes that could not be created at start-up, e.g. conflicting with an
+# existing index of the same name
+index_log = logging.getLogger("indexes")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Open the connection pools before serving the first request
+    await run_in_threadpool(client.admin.command, 'ping')
+    if async_client is not None:
+        await async_client.admin.command('ping')
+    _, errors = await run_in_threadpool(ensure_indexes, db)
+    for collection, error in errors.items():
+        index_log.warning("Index creation failed on %s: %s", collection, error)
+    if cache_warmer.interval:
+        cache_warmer.start()
+    yield
+    await cache_warmer.stop()
+    client.close()
+    if async_client is not None:
+        await async_client.close()
+
+app = FastAPI(lifespan=lifespan)
+# Results are encoded after content negotiation (see encoding.py)
+app.router.route_class = NegotiatedRoute
+
+# Endpoints whose response does not only depend on the data and the query
+UNVERSIONED_PATHS = ('/admission/', '/cache/', '/columnar/stats', '/debug/', '/metrics')
+
+# Strong validator of a GET response: the data version (and the columnar
+# snapshot version when the snapshot answers) with the path, the query and
+# the negotiated representation
+def request_etag(request):
+    version = result_cache.current_version
+    if request.query_params.get('source') == 'columnar':
+        version = (version, columnar_engine.snapshot_version)
+    representation = (request.headers.get('accept', ''), request.headers.get('accept-encoding', ''))
+    key = f"{version}|{request.url.path}|{sorted(request.query_params.multi_items())}|{representation}"
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+# The keyset cursor of a page (X-Next-Cursor) rides in its ETag, after a dot,
+# so that a 304 can give it back without running the endpoint
+def cursor_etag(etag, cursor):
+    return f'{etag[:-1]}.{cursor}"' if cursor else etag
+
+def split_etag(tag):
+    validator, _, cursor = tag.strip('"').partition('.')
+    return f'"{validator}"', cursor or None
+
+# Ages in seconds of the stale results a request was served, filled by aggregate()
+stale_ages = ContextVar('stale_ages', default=None)
+
+# Conditional GETs: a matching If-None-Match is answered with 304 before the
+# endpoint runs, so revalidating unchanged data costs one version check. That
+# check, made in a thread, is also the one the result cache reads under
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    if request.method != 'GET' or request.url.path.startswith(UNVERSIONED_PATHS):
+        return await call_next(request)
+    await run_in_threadpool(result_cache.check_version)
+    etag = request_etag(request)
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match.strip() == '*':
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+    for tag in if_none_match.split(','):
+        validator, cursor = split_etag(tag.strip())
+        if validator == etag:
+            headers = {'ETag': tag.strip(), 'Cache-Control': 'no-cache'}
+            if cursor:
+                headers['X-Next-Cursor'] = cursor
+            return Response(status_code=304, headers=headers)
+    ages = []
+    token = stale_ages.set(ages)
+    try:
+        response = await call_next(request)
+    finally:
+        stale_ages.reset(token)
+    # A stale response is marked with its age and gets no validator, which
+    # would otherwise pin it as the current version of the data. Nor does a
+    # response computed while the data changed
+    if ages:
+        response.headers['Age'] = str(int(max(ages)))
+        response.headers['Cache-Control'] = 'no-cache'
+    elif response.status_code == 200 and request_etag(request) == etag:
+        response.headers['ETag'] = cursor_etag(etag, response.headers.get('X-Next-Cursor'))
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Requests slower than SLOW_REQUEST_MS are logged with the pipelines they ran
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0)) or None
+slow_log = logging.getLogger("slow_requests")
+
+# Route template of the request, for the responses given before routing
+# such as the 304s of conditional_get
+def route_template(scope):
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+# Timing and response size of every request, labelled by route and year. The
+# labels and the pipelines run are kept in context variables, which the Mongo
+# command listener and the response encoder also read
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    start = time.perf_counter()
+    # The endpoint label is set to the route template by NegotiatedRoute once
+    # the route is matched
+    labels = {'endpoint': 'unmatched', 'year': metrics.year_label(request.query_params.get('year'))}
+    pipelines = []
+    labels_token = metrics.request_labels.set(labels)
+    pipelines_token = metrics.request_pipelines.set(pipelines)
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_labels.reset(labels_token)
+        metrics.request_pipelines.reset(pipelines_token)
+    if labels['endpoint'] == 'unmatched':
+        labels['endpoint'] = route_template(request.scope)
+    body = response.body_iterator
+
+    async def measured_body():
+        size = 0
+        async for chunk in body:
+            size += len(chunk)
+            yield chunk
+        elapsed = time.perf_counter() - start
+        metrics.RESPONSE_BYTES.observe(size, **labels)
+        metrics.REQUEST_SECONDS.observe(elapsed, status=response.status_code, **labels)
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            slow_log.warning(json.dumps({
+                'path': request.url.path,
+                'query': str(request.query_params),
+                'status': response.status_code,
+                'durationMs': round(elapsed * 1000, 1),
+                'bytes': size,
+                'pipelines': pipelines
+            }, default=str))
+
+    response.body_iterator = measured_body()
+    return response
+
+# GET requests whose client went away are cancelled, which stops their
+# pipelines on the server unless other requests share them (see run_pipeline).
+# Added last so that it wraps the other middlewares and reads the messages of
+# the server itself
+app.add_middleware(admission.CancelOnDisconnect)
+
+# Orders only reference their product: a category filter becomes a filter on
+# the Product IDs of that category. Returns the `category` argument of
+# filter_orders; the products dimension is read on the threadpool, since it
+# may check the data version or reload Products
+async def category_predicate(filters):
+    if not filters or not filters.category:
+        return None
+    product_ids = await run_in_threadpool(products.product_ids, filters.category)
+    return lambda category: {'Product ID': {'$in': product_ids}}
+
+# Query parameter selecting where an endpoint reads from: the raw Orders
+# collection, the pre-aggregated rollup cube (see rollup.py), the in-memory
+# columnar snapshot (see columnar.py) or the running aggregates maintained by
+# POST /orders (see running.py)
+SOURCE = Query("orders", pattern="^(orders|cube|columnar|running)$")
+
+# Set by /debug/explain: aggregate() then hands the final pipeline back
+# through CapturedPipeline instead of running it
+capture_pipeline = ContextVar('capture_pipeline', default=False)
+# Set by the cache warmer: aggregate() then recomputes the result even when
+# it is cached
+warming = ContextVar('warming', default=False)
+
+class CapturedPipeline(Exception):
+    def __init__(self, collection, pipeline):
+        super().__init__(collection)
+        self.collection = collection
+        self.pipeline = pipeline
+
+# Helper function running a pipeline with the configured driver, within the
+# time budget and the concurrency limit of its class (see admission.py)
+async def run_pipeline(collection, pipeline, name=None, admitted=False):
+    # The name labels the command metrics; the comment, the name made unique,
+    # shows up in the Mongo logs and profiler and identifies the run to kill
+    comment = f"{name}:{uuid.uuid4().hex[:12]}"
+    options = {'comment': comment, 'maxTimeMS': admission.max_time_ms(name)}
+
+    async def fetch():
+        cursor = await async_db[collection].aggregate(pipeline, **options)
+        return await cursor.to_list()
+
+    token = metrics.current_pipeline.set(name)
+    try:
+        # `admitted` runs already hold the slot of their request
+        async with nullcontext() if admitted else admission.limiter(name).slot(patient=warming.get()):
+            if async_db is not None:
+                run = asyncio.ensure_future(fetch())
+            else:
+                run = asyncio.ensure_future(run_in_threadpool(lambda: list(db[collection].aggregate(pipeline, **options))))
+            try:
+                return await asyncio.shield(run)
+            except asyncio.CancelledError:
+                # Nobody waits for the result anymore: stop the pipeline on the server
+                run.add_done_callback(lambda done: done.cancelled() or done.exception())
+                await run_in_threadpool(admission.kill_operations, client, comment)
+                raise
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail=f"{name} exceeded its {options['maxTimeMS']} ms budget")
+    finally:
+        metrics.current_pipeline.reset(token)
+
+# `$match` predicates of the Order Date partitions of a query, none when it
+# is not partitioned: partitioning is off, a year is selected or the range of
+# the filters spans too few days. The range is bounded by the orders dated
+async def order_partitions(filters):
+    if QUERY_PARTITIONS < 2 or filters.year:
+        return []
+    years = await cached_year_index()
+    if not years:
+        return []
+    low, high = filters.date_range()
+    first, last = years[0]['firstOrderDate'], years[-1]['lastOrderDate']
+    low = max(low, first) if low else first
+    high = min(high, last) if high else last
+    return partitioned.partition_predicates(low, high, QUERY_PARTITIONS)
+
+# Helper function running the partial pipeline of a plan (see partitioned.py)
+# on each partition at once and merging the partial groups. The request holds
+# a single slot of its admission class for all its partitions, so that it is
+# admitted or shed as a whole; when one partition fails, the others are
+# cancelled
+async def run_partitioned(name, plan, filters, predicates):
+    stages, reduce = plan
+    category = await category_predicate(filters)
+    async with admission.limiter(name).slot(patient=warming.get()):
+        runs = [
+            asyncio.ensure_future(run_pipeline(
+                'Orders', [{'$match': predicate}] + filter_orders(list(stages), filters, category=category),
+                name, admitted=True
+            ))
+            for predicate in predicates
+        ]
+        try:
+            parts = await asyncio.gather(*runs)
+        finally:
+            for run in runs:
+                run.cancel()
+    return await run_in_threadpool(lambda: reduce(partitioned.merge([row for part in parts for row in part], stages[-1])))
+
+# Helper function running an endpoint pipeline against the selected source,
+# through the result cache. The final pipeline is part of the key, so it covers
+# every filter. `finalize` post-processes the rows of the Orders pipeline
+# before they are cached; the cube pipeline, by default the one of
+# rollup.CUBE_PIPELINES, already gives the final documents. Without a year,
+# the Orders pipelines with a plan in partitioned.PLANS run partitioned unless
+# `partition` is False
+async def aggregate(endpoint, pipeline, filters, source='orders', finalize=None, cube_pipeline=None,
+                    partition=True):
+    if source == 'running':
+        if endpoint not in running.RUNNING_QUERIES:
+            raise HTTPException(status_code=400, detail=f"{endpoint} is not available from the running source")
+        if filters.model_dump(exclude={'year'}, exclude_none=True):
+            raise HTTPException(status_code=400, detail="The running source only supports the year filter")
+        rows = await run_in_threadpool(running.query, db, endpoint, filters.year)
+        if rows is None:
+            raise HTTPException(status_code=503, detail="The running aggregates are not built yet, run python running.py")
+        return rows
+    if source == 'columnar':
+        if endpoint not in columnar.QUERIES:
+            raise HTTPException(status_code=400, detail=f"{endpoint} is not available from the columnar source")
+        # Vectorized over the in-memory snapshot, fast enough not to be cached
+        return await run_in_threadpool(columnar_engine.query, endpoint, filters)
+    if source == 'cube' and not cube_pipeline and endpoint not in rollup.CUBE_PIPELINES:
+        raise HTTPException(status_code=400, detail=f"{endpoint} is not available from the cube source")
+    if source == 'cube':
+        collection = rollup.CUBE_COLLECTION
+        pipeline = filter_orders(list(cube_pipeline or rollup.CUBE_PIPELINES[endpoint]), filters, 'day')
+        finalize = None
+    else:
+        collection = 'Orders'
+        pipeline = filter_orders(pipeline, filters, category=await category_predicate(filters))
+    if capture_pipeline.get():
+        raise CapturedPipeline(collection, pipeline)
+    key = (endpoint, collection, repr(pipeline))
+
+    plan = partitioned.PLANS.get(endpoint) if partition and source == 'orders' else None
+
+    async def compute():
+        start = time.perf_counter()
+        # The merged result equals the one of the single pipeline, so both
+        # share the cache key
+        predicates = await order_partitions(filters) if plan else []
+        if predicates:
+            result = await run_partitioned(endpoint, plan, filters, predicates)
+        else:
+            result = await run_pipeline(collection, pipeline, endpoint)
+        ran = metrics.request_pipelines.get()
+        if ran is not None:
+            ran.append({'name': endpoint, 'collection': collection, 'pipeline': pipeline,
+                        'partitions': len(predicates) or None,
+                        'durationMs': round((time.perf_counter() - start) * 1000, 1)})
+        if finalize:
+            # Off the event loop: finalizers read the products dimension
+            result = await run_in_threadpool(finalize, result)
+        result_cache.set(key, result)
+        return result
+
+    # Identical requests share the run in flight; the data version is part of
+    # the key so that a request made after a write never gets older results
+    flight_key = (result_cache.current_version,) + key
+    if not warming.get():
+        found, result = result_cache.get(key)
+        if found:
+            return result
+        # Stale while revalidate: the previous result is served at once and
+        # recomputed in the background
+        found, result, age = result_cache.get_stale(key)
+        if found:
+            in_flight.start(flight_key, compute, detached=True)
+            ages = stale_ages.get()
+            if ages is not None:
+                ages.append(age)
+            return result
+    return await in_flight.run(flight_key, compute)
 
 @app.get("/total_sales")
-def total_sales(year: int = Query(None)):
+async def total_sales(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {'$group': {'_id': None, 'totalSales': {'$sum': '$Sales'}}}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_sales', pipeline, filters, source)
     return result
 
 @app.get("/total_profits")
-def total_profits(year: int = Query(None)):
+async def total_profits(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {'$group': {'_id': None, 'totalProfit': {'$sum': '$Profit'}}}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_profits', pipeline, filters, source)
     return result
 
 @app.get("/total_orders")
-def total_orders(year: int = Query(None)):
+async def total_orders(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {'$count': 'Order ID'}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_orders', pipeline, filters, source)
     return result
 
 @app.get("/average_sales")
-def average_sales(year: int = Query(None)):
+async def average_sales(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {'$group': {
             '_id': None,
@@ -57,28 +451,44 @@ def average_sales(year: int = Query(None)):
             'averageSalesPerOrder': {'$divide': ['$totalSales', '$orderCount']}
         }}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('average_sales', pipeline, filters, source)
     return result
 
 @app.get("/total_quantity")
-def total_quantity(year: int = Query(None)):
+async def total_quantity(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {'$group': {'_id': None, 'totalQuantity': {'$sum': '$Quantity'}}}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_quantity', pipeline, filters, source)
     return result
 
+# Query parameter switching the distinct-customer KPIs from the HyperLogLog
+# sketches (see sketches.py) to an exact group by Customer ID
+EXACT = Query(False, description="Exact count instead of the customer sketches estimate")
+
+# Distinct customers of the filtered orders, estimated by merging the daily
+# customer sketches. None when the sketches cannot answer the filters, which
+# only cover days and segments, or are older than the last write
+async def approximate_customers(filters):
+    if filters.category or filters.ship_mode:
+        return None
+    key = ('approximate_customers', repr(filters))
+    found, customers = result_cache.get(key) if not warming.get() else (False, None)
+    if not found:
+        sketch = await run_in_threadpool(merged_customer_sketch, db, filters.match('day'))
+        customers = sketch.count() if sketch else None
+        result_cache.set(key, customers)
+    return customers
+
 @app.get("/total_client")
-def total_client(year: int = Query(None)):
+async def total_client(filters: OrderFilters = Depends(order_filters), exact: bool = EXACT,
+                       source: str = SOURCE):
+    if not exact and source == 'orders':
+        customers = await approximate_customers(filters)
+        if customers is not None:
+            return [{'Customers ID': customers, 'approximate': True}]
     pipeline = [
     {
-        '$lookup': {
-            'from': 'Customers',
-            'localField': 'Customers ID',
-            'foreignField': 'Customers ID',
-            'as': 'CustomersDetails'
-        }
-    }, {
         '$group': {
             '_id': '$Customer ID'
         }
@@ -86,11 +496,131 @@ def total_client(year: int = Query(None)):
         '$count': 'Customers ID'
     }
 ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_client', pipeline, filters, source)
     return result
 
+class OrderIn(BaseModel):
+    """Order of POST /orders; fields other than these are stored as given."""
+    model_config = ConfigDict(extra='allow', populate_by_name=True)
+
+    order_id: str = Field(alias='Order ID')
+    order_date: datetime = Field(alias='Order Date')
+    ship_date: datetime | None = Field(None, alias='Ship Date')
+    ship_mode: str = Field(alias='Ship Mode')
+    customer_id: str = Field(alias='Customer ID')
+    segment: str = Field(alias='Segment')
+    product_id: str = Field(alias='Product ID')
+    sales: float = Field(alias='Sales')
+    profit: float = Field(0, alias='Profit')
+    quantity: int = Field(alias='Quantity')
+
+# Bulk ingestion: the orders are inserted unordered and the inserted ones are
+# added to the running aggregates with $inc upserts, which keeps the
+# source=running reads exact. Orders rejected by the server (duplicate keys,
+# validation) are reported by index
+@app.post("/orders")
+async def post_orders(orders: list[OrderIn]):
+    if len(orders) > 10000:
+        raise HTTPException(status_code=413, detail="At most 10000 orders per request")
+    docs = [leadtime.with_lead_time(order.model_dump(by_alias=True, exclude_none=True)) for order in orders]
+    inserted, errors = await run_in_threadpool(lambda: running.insert_orders(db, docs, products.lookup()))
+    return {'inserted': inserted, 'errors': errors}
+
+class GlobalKPIs(BaseModel):
+    totalSales: float = 0
+    totalProfit: float = 0
+    totalOrders: int = 0
+    totalQuantity: int = 0
+    totalClients: int = 0
+    averageOrdersPerCustomer: float = 0
+
+# All the global KPIs in a single pass over Orders: orders are first grouped
+# per customer, then the per-customer rows are folded into the totals
+@app.get("/kpis", response_model=GlobalKPIs)
+async def global_kpis(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    pipeline = [
+        {'$group': {
+            '_id': '$Customer ID',
+            'sales': {'$sum': '$Sales'},
+            'profit': {'$sum': '$Profit'},
+            'quantity': {'$sum': '$Quantity'},
+            'orderCount': {'$sum': 1}
+        }},
+        {'$group': {
+            '_id': None,
+            'totalSales': {'$sum': '$sales'},
+            'totalProfit': {'$sum': '$profit'},
+            'totalOrders': {'$sum': '$orderCount'},
+            'totalQuantity': {'$sum': '$quantity'},
+            'totalClients': {'$sum': 1},
+            'averageOrdersPerCustomer': {'$avg': '$orderCount'}
+        }},
+        {'$project': {'_id': 0}}
+    ]
+    result = await aggregate('kpis', pipeline, filters, source)
+    return GlobalKPIs(**result[0]) if result else GlobalKPIs()
+
+# Query parameter of /kpis_by_year listing the years to compare, all by default
+YEARS = Query(None, pattern=r"^\d{4}(,\d{4})*$", description="Comma separated years, e.g. 2015,2016,2017")
+
+# Change of every KPI against the previous calendar year, absolute (Delta) and
+# relative (Growth); None when the previous year has no orders
+def year_over_year(rows, years=None):
+    by_year = {row['year']: row for row in rows if row.get('year') is not None}
+    result = []
+    for year in sorted(years or by_year):
+        row = dict(GlobalKPIs(**by_year.get(year, {})).model_dump(), year=year)
+        previous = by_year.get(year - 1)
+        for field in GlobalKPIs.model_fields:
+            delta = row[field] - previous[field] if previous else None
+            row[f'{field}Delta'] = delta
+            row[f'{field}Growth'] = delta / previous[field] if previous and previous[field] else None
+        result.append(row)
+    return result
+
+# The global KPIs of several years side by side in a single pass: the year is
+# added to the grouping keys of the /kpis pipeline. The year before the first
+# one asked for is read too, for its year-over-year deltas
+@app.get("/kpis_by_year")
+async def kpis_by_year(filters: OrderFilters = Depends(order_filters), years: str = YEARS,
+                       source: str = SOURCE):
+    if years and filters.year:
+        raise HTTPException(status_code=422, detail="Use either the year or the years filter")
+    selected = sorted({int(year) for year in years.split(',')}) if years else None
+    if selected and (selected[0] < 1 or selected[-1] > MAX_YEAR):
+        raise HTTPException(status_code=422, detail=f"years must be between 1 and {MAX_YEAR}")
+    if selected:
+        low, high = date(max(selected[0] - 1, 1), 1, 1), date(selected[-1], 12, 31)
+        filters = filters.model_copy(update={
+            'start': max(filters.start, low) if filters.start else low,
+            'end': min(filters.end, high) if filters.end else high
+        })
+    pipeline = [
+        {'$group': {
+            '_id': {'year': {'$year': '$Order Date'}, 'customer': '$Customer ID'},
+            'sales': {'$sum': '$Sales'},
+            'profit': {'$sum': '$Profit'},
+            'quantity': {'$sum': '$Quantity'},
+            'orderCount': {'$sum': 1}
+        }},
+        {'$group': {
+            '_id': '$_id.year',
+            'totalSales': {'$sum': '$sales'},
+            'totalProfit': {'$sum': '$profit'},
+            'totalOrders': {'$sum': '$orderCount'},
+            'totalQuantity': {'$sum': '$quantity'},
+            'totalClients': {'$sum': 1},
+            'averageOrdersPerCustomer': {'$avg': '$orderCount'}
+        }},
+        {'$project': {'_id': 0, 'year': '$_id', 'totalSales': 1, 'totalProfit': 1, 'totalOrders': 1,
+                      'totalQuantity': 1, 'totalClients': 1, 'averageOrdersPerCustomer': 1}}
+    ]
+    # The requested years are picked after the cache, whose key is the pipeline
+    result = await aggregate('kpis_by_year', pipeline, filters, source)
+    return year_over_year(result, selected)
+
 @app.get("/ship_mode")
-def ship_mode(year: int = Query(None)):
+async def ship_mode(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
     {
         '$group': {
@@ -105,11 +635,11 @@ def ship_mode(year: int = Query(None)):
         }
     }
 ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('ship_mode', pipeline, filters, source)
     return result
 
 @app.get("/average_per_ship_mode")
-def average_per_ship_mode(year: int = Query(None)):
+async def average_per_ship_mode(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
     {
         '$project': {
@@ -140,94 +670,49 @@ def average_per_ship_mode(year: int = Query(None)):
         }
     }
 ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('average_per_ship_mode', pipeline, filters, source)
     return result
 
 @app.get("/quantity_by_category")
-def quantity_by_category(year: int = Query(None)):
+async def quantity_by_category(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    # Grouped by product, then folded into categories with the products dimension
     pipeline = [
-        {
-            '$lookup': {
-                'from': 'Products',
-                'localField': 'Product ID',
-                'foreignField': 'Product ID',
-                'as': 'ProductDetails'
-            }
-        },
-        {
-            '$unwind': '$ProductDetails'
-        },
         {
             '$group': {
-                '_id': '$ProductDetails.Category',
+                '_id': '$Product ID',
                 'totalQuantity': {
                     '$sum': '$Quantity'
                 }
             }
-        },
-        {
-            '$project': {
-                'Category': '$_id',
-                'totalQuantity': 1,
-                '_id': 0
-            }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('quantity_by_category', pipeline, filters, source,
+                             lambda rows: by_category(products, rows, ['totalQuantity']))
     return result
 
 @app.get("/category_by_segment")
-def category_by_segment(year: int = Query(None)):
+async def category_by_segment(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    # Grouped by segment and product, the top category of each segment is then
+    # picked with the products dimension
     pipeline = [
-        {
-            '$lookup': {
-                'from': 'Products',
-                'localField': 'Product ID',
-                'foreignField': 'Product ID',
-                'as': 'ProductDetails'
-            }
-        },
-        {
-            '$unwind': '$ProductDetails'
-        },
         {
             '$group': {
                 '_id': {
                     'Segment': '$Segment',
-                    'Category': '$ProductDetails.Category'
+                    'Product ID': '$Product ID'
                 },
                 'TotalOrders': {
-                    '$sum': 1  # Count the number of orders for each category
+                    '$sum': 1  # Count the number of orders for each product
                 }
             }
-        },
-        {
-            '$sort': {
-                '_id.Segment': 1,  # Sort by Segment alphabetically
-                'TotalOrders': -1  # Sort by TotalOrders in descending order
-            }
-        },
-        {
-            '$group': {
-                '_id': '$_id.Segment',
-                'TopCategory': {
-                    '$first': '$_id.Category'  # Take only the top category for each segment
-                }
-            }
-        },
-        {
-            '$project': {
-                '_id': 0,
-                'Segment': '$_id',
-                'TopCategory': 1
-            }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('category_by_segment', pipeline, filters, source,
+                             lambda rows: top_category_by_segment(products, rows))
     return result
 
 @app.get("/total_orders_by_segment")
-def total_orders_by_segment(year: int = Query(None)):
+async def total_orders_by_segment(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {
             '$group': {
@@ -245,11 +730,11 @@ def total_orders_by_segment(year: int = Query(None)):
             }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_orders_by_segment', pipeline, filters, source)
     return result
 
 @app.get("/revenue_by_segment")
-def revenue_by_segment(year: int = Query(None)):
+async def revenue_by_segment(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
     pipeline = [
         {
             '$group': {
@@ -267,91 +752,277 @@ def revenue_by_segment(year: int = Query(None)):
             }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('revenue_by_segment', pipeline, filters, source)
     return result
 
 @app.get("/total_orders_by_category")
-def total_orders_by_category(year: int = Query(None)):
+async def total_orders_by_category(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    # Grouped by product, then folded into categories with the products dimension
     pipeline = [
-        {
-            '$lookup': {
-                'from': 'Products',
-                'localField': 'Product ID',
-                'foreignField': 'Product ID',
-                'as': 'ProductDetails'
-            }
-        },
-        {
-            '$unwind': '$ProductDetails'
-        },
         {
             '$group': {
-                '_id': '$ProductDetails.Category',
+                '_id': '$Product ID',
                 'totalOrders': {
                     '$sum': 1
                 }
             }
-        },
-        {
-            '$project': {
-                'Category': '$_id',
-                'totalOrders': 1,
-                '_id': 0
-            }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('total_orders_by_category', pipeline, filters, source,
+                             lambda rows: by_category(products, rows, ['totalOrders']))
     return result
 
 @app.get("/revenue_by_category")
-def revenue_by_category(year: int = Query(None)):
+async def revenue_by_category(filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    # Grouped by product, then folded into categories with the products dimension
     pipeline = [
-        {
-            '$lookup': {
-                'from': 'Products',
-                'localField': 'Product ID',
-                'foreignField': 'Product ID',
-                'as': 'ProductDetails'
-            }
-        },
-        {
-            '$unwind': '$ProductDetails'
-        },
         {
             '$group': {
-                '_id': '$ProductDetails.Category',
+                '_id': '$Product ID',
                 'totalSales': {
                     '$sum': '$Sales'
                 }
             }
-        },
-        {
-            '$project': {
-                'Category': '$_id',
-                'totalSales': 1,
-                '_id': 0
-            }
         }
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('revenue_by_category', pipeline, filters, source,
+                             lambda rows: by_category(products, rows, ['totalSales']))
     return result
 
 @app.get("/average_orders_by_customers")
-def average_orders_by_customers(year: int = Query(None)):
+async def average_orders_by_customers(filters: OrderFilters = Depends(order_filters), exact: bool = EXACT,
+                                      source: str = SOURCE):
+    if not exact and source == 'orders':
+        customers = await approximate_customers(filters)
+        if customers:
+            orders = await aggregate('total_orders', [{'$count': 'Order ID'}], filters)
+            average = orders[0]['Order ID'] / customers if orders else 0
+            return [{'_id': None, 'averageOrdersPerCustomer': average, 'approximate': True}]
     pipeline = [
         {'$group': {'_id': '$Customer ID', 'orderCount': {'$sum': 1}}},
         {'$group': {'_id': None, 'averageOrdersPerCustomer': {'$avg': '$orderCount'}}}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    result = await aggregate('average_orders_by_customers', pipeline, filters, source)
+    return result
+
+# Query parameter of /percentiles listing the percentiles returned
+PERCENTILES = Query("50,90,99", pattern=r"^\d+(\.\d+)?(,\d+(\.\d+)?)*$",
+                    description="Comma separated percentiles from 0 to 100, e.g. 50,90,99.9")
+
+# Measures of /percentiles read from the value sketches (see sketches.py)
+SKETCHED_MEASURES = {'order_value': 'sales', 'profit': 'profit'}
+# Fields of the groups of /percentiles
+PERCENTILE_GROUPS = {'segment': 'Segment', 'category': 'Category'}
+
+# Sketches of the measure per group, merged from the daily value sketches of
+# the filtered days, segment and category. None when they are stale
+async def value_sketches(measure, filters, field):
+    key = ('value_sketches', measure, field, repr(filters))
+    found, sketches = result_cache.get(key) if not warming.get() else (False, None)
+    if not found:
+        sketches = await run_in_threadpool(merged_value_sketches, db, measure, filters.match('day'), field)
+        result_cache.set(key, sketches)
+    return sketches
+
+# Category of each group of rows grouped by Product ID, the group itself otherwise
+def percentile_group(lookup, value):
+    if lookup is None:
+        return value
+    return next((product.get('Category') for product in lookup.get(value, [])), None)
+
+# Sketches of the measure per group built from the filtered orders themselves,
+# when the value sketches are stale: rows grouped by Segment or Product ID and
+# value, with their number of orders
+def order_value_sketches(rows, by):
+    lookup = products.lookup() if by == 'category' else None
+    values = {}
+    for row in rows:
+        value = row['_id'].get('value')
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        group = values.setdefault(percentile_group(lookup, row['_id'].get('group')), ([], []))
+        group[0].append(value)
+        group[1].append(row['orders'])
+    return {group: TDigest().add(*weighted).compress() for group, weighted in values.items()}
+
+# Revenue of each customer over the filtered orders folded into one sketch per
+# group, from rows grouped by customer and Segment or Product ID. A product
+# counts in the category of its first product, like the category endpoints
+def customer_revenue_sketches(rows, by):
+    revenues = {}
+    lookup = products.lookup() if by == 'category' else None
+    for row in rows:
+        customer, group = row['_id'].get('customer'), percentile_group(lookup, row['_id'].get('group'))
+        revenues[customer, group] = revenues.get((customer, group), 0) + row['revenue']
+    totals = {}
+    for (_, group), revenue in revenues.items():
+        totals.setdefault(group, []).append(revenue)
+    return {group: TDigest().add(values).compress() for group, values in totals.items()}
+
+# Any percentile of the value of orders, their profit or the revenue per
+# customer, overall or per segment or category. Order values and profits merge
+# the t-digests of the filtered days in bounded memory, or are grouped from the
+# filtered orders while the t-digests are stale; customer revenues are grouped
+# per customer first, which needs no sort of Orders either
+@app.get("/percentiles")
+async def percentiles(
+    filters: OrderFilters = Depends(order_filters),
+    measure: str = Query("order_value", pattern="^(order_value|profit|customer_revenue)$"),
+    by: str = Query(None, pattern="^(segment|category)$"),
+    percentiles: str = PERCENTILES
+):
+    ranks = [float(rank) for rank in percentiles.split(',')]
+    if any(rank > 100 for rank in ranks):
+        raise HTTPException(status_code=422, detail="Percentiles range from 0 to 100")
+    field = PERCENTILE_GROUPS.get(by)
+    group = {'segment': '$Segment', 'category': '$Product ID'}.get(by)
+    if measure == 'customer_revenue':
+        pipeline = [
+            {'$group': {'_id': {'customer': '$Customer ID', 'group': group}, 'revenue': {'$sum': '$Sales'}}}
+        ]
+        # The sketches are cached, the percentiles are picked per request
+        sketches = await aggregate('customer_revenue_percentiles', pipeline, filters,
+                                   finalize=lambda rows: customer_revenue_sketches(rows, by))
+    else:
+        if filters.ship_mode:
+            raise HTTPException(status_code=400, detail="The value sketches only cover days, segments and categories")
+        sketches = await value_sketches(SKETCHED_MEASURES[measure], filters, field)
+        if sketches is None:
+            pipeline = [{'$group': {
+                '_id': {'group': group, 'value': VALUE_MEASURES[SKETCHED_MEASURES[measure]]},
+                'orders': {'$sum': 1}
+            }}]
+            sketches = await aggregate('value_percentiles', pipeline, filters,
+                                       finalize=lambda rows: order_value_sketches(rows, by))
+    result = []
+    for group, sketch in sorted(sketches.items(), key=lambda item: str(item[0])):
+        if not sketch.count():
+            continue
+        row = {field: group} if field else {}
+        row.update({'count': sketch.count(), 'min': float(sketch.min), 'max': float(sketch.max)})
+        row.update({f"p{rank:g}": sketch.quantile(rank / 100) for rank in ranks})
+        result.append(row)
     return result
 
+# Query parameter of the lead time endpoints: the fields grouped by, e.g.
+# ship_mode,segment; all the orders together by default
+LEAD_TIME_BY = Query(None, pattern="^(ship_mode|segment)(,(ship_mode|segment))?$",
+                     description="ship_mode, segment or ship_mode,segment")
+
+def lead_time_fields(by):
+    return [leadtime.GROUPS[name] for name in dict.fromkeys(by.split(','))] if by else []
+
+# Orders per ship mode x segment x lead time, read from the materialized
+# integer `Lead Time` (see leadtime.py), from which the lead time endpoints
+# fold their groups. Orders not shipped have no lead time and are left out
+async def lead_time_counts(filters):
+    return await aggregate('lead_time', leadtime.lead_time_pipeline(), filters)
+
+@app.get("/lead_time/histogram")
+async def lead_time_histogram(filters: OrderFilters = Depends(order_filters), by: str = LEAD_TIME_BY):
+    return leadtime.histogram(await lead_time_counts(filters), lead_time_fields(by))
+
+@app.get("/lead_time/percentiles")
+async def lead_time_percentiles(filters: OrderFilters = Depends(order_filters), by: str = LEAD_TIME_BY,
+                                percentiles: str = PERCENTILES):
+    ranks = [float(rank) for rank in percentiles.split(',')]
+    if any(rank > 100 for rank in ranks):
+        raise HTTPException(status_code=422, detail="Percentiles range from 0 to 100")
+    return leadtime.percentiles(await lead_time_counts(filters), lead_time_fields(by), ranks)
+
+# Orders shipped later than promised, by default the SLA of their ship mode
+# (leadtime.SLA_DAYS), or later than `days` whatever their ship mode
+@app.get("/lead_time/sla")
+async def lead_time_sla(filters: OrderFilters = Depends(order_filters), by: str = LEAD_TIME_BY,
+                        days: int = Query(None, ge=0, description="Lead time promised to every ship mode")):
+    return leadtime.sla_breaches(await lead_time_counts(filters), lead_time_fields(by), days)
+
+# Sort orders of retention_by_customers: (field, direction). Ties are broken
+# by customer name, which makes every order a stable keyset
+RETENTION_SORTS = {
+    'name': ('_id', 1),
+    'retention': ('retentionPeriodDays', -1),
+    'orders': ('orderCount', -1)
+}
+
+def encode_cursor(row, field):
+    return base64.urlsafe_b64encode(json.dumps([row[field], row['_id']]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        value, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, name
+
+# Rows after the keyset cursor in the (field, direction), then name order
+def after_cursor(cursor, field, direction):
+    value, name = decode_cursor(cursor)
+    if field == '_id':
+        return {'_id': {'$gt': name}}
+    beyond = '$lt' if direction < 0 else '$gt'
+    return {'$or': [{field: {beyond: value}}, {field: value, '_id': {'$gt': name}}]}
+
+def ndjson_line(doc):
+    return json.dumps(doc, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value))
+
+# Stream the pipeline results as NDJSON, one chunk per cursor batch, without
+# holding the whole result in memory
+def stream_ndjson(collection, pipeline, batch_size=1000, name=None):
+    ran = metrics.request_pipelines.get()
+    if ran is not None:
+        ran.append({'name': name, 'collection': collection, 'pipeline': pipeline})
+    if async_db is not None:
+        async def lines():
+            cursor = await async_db[collection].aggregate(pipeline, batchSize=batch_size, comment=name,
+                                                         maxTimeMS=admission.max_time_ms(name))
+            chunk = []
+            async for doc in cursor:
+                chunk.append(ndjson_line(doc) + '\n')
+                if len(chunk) == batch_size:
+                    yield ''.join(chunk)
+                    chunk = []
+            if chunk:
+                yield ''.join(chunk)
+    else:
+        # Iterated on the threadpool by StreamingResponse
+        def lines():
+            chunk = []
+            for doc in db[collection].aggregate(pipeline, batchSize=batch_size, comment=name,
+                                                maxTimeMS=admission.max_time_ms(name)):
+                chunk.append(ndjson_line(doc) + '\n')
+                if len(chunk) == batch_size:
+                    yield ''.join(chunk)
+                    chunk = []
+            if chunk:
+                yield ''.join(chunk)
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
 @app.get("/retention_by_customers")
-def retention_by_customers(year: int = Query(None)):
+async def retention_by_customers(
+    response: Response,
+    filters: OrderFilters = Depends(order_filters),
+    sort: str = Query("name", pattern=f"^({'|'.join(RETENTION_SORTS)})$"),
+    limit: int = Query(None, ge=1, le=10000, description="Page size, or N of a top-N sort"),
+    cursor: str = Query(None, description="X-Next-Cursor header of the previous page"),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    source: str = SOURCE
+):
+    if source != 'orders' and (limit or cursor or sort != 'name' or format != 'json'):
+        raise HTTPException(status_code=400, detail="Pagination, sorts and NDJSON need the orders source")
+    # Orders are grouped per customer before the join, so Customers is looked
+    # up once per customer rather than once per order
     pipeline = [
+        {'$group': {
+            '_id': '$Customer ID',
+            'firstOrderDate': {'$min': '$Order Date'},
+            'lastOrderDate': {'$max': '$Order Date'},
+            'orderCount': {'$sum': 1}
+        }},
     {
         '$lookup': {
             'from': 'Customers',
-            'localField': 'Customer ID',
+            'localField': '_id',
             'foreignField': 'Customer ID',
             'as': 'CustomerDetails'
         }
@@ -360,9 +1031,9 @@ def retention_by_customers(year: int = Query(None)):
     }, {
             '$group': {
             '_id': '$CustomerDetails.Customer Name',
-            'firstOrderDate': {'$min': '$Order Date'},
-            'lastOrderDate': {'$max': '$Order Date'},
-            'orderCount': {'$sum': 1}
+            'firstOrderDate': {'$min': '$firstOrderDate'},
+            'lastOrderDate': {'$max': '$lastOrderDate'},
+            'orderCount': {'$sum': '$orderCount'}
         }},
         {'$project': {
             'Customer Name': '$_id',
@@ -378,15 +1049,171 @@ def retention_by_customers(year: int = Query(None)):
         }},
         {'$match': {'orderCount': {'$gt': 1}}}
     ]
-    result = list(db.Orders.aggregate(filter_by_year(pipeline, year)))
+    field, direction = RETENTION_SORTS[sort]
+    if limit or cursor or sort != 'name':
+        pipeline.append({'$sort': {field: direction, '_id': 1} if field != '_id' else {'_id': 1}})
+    if cursor:
+        pipeline.append({'$match': after_cursor(cursor, field, direction)})
+    if limit:
+        pipeline.append({'$limit': limit})
+    if format == 'ndjson':
+        return stream_ndjson('Orders', filter_orders(pipeline, filters, category=await category_predicate(filters)),
+                             name='retention_by_customers')
+    # Only the whole list, unsorted, is merged from partitions
+    result = await aggregate('retention_by_customers', pipeline, filters, source,
+                             partition=not (limit or cursor or sort != 'name'))
+    if limit and len(result) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(result[-1], field)
     return result
 
 
+@app.get("/sales_timeseries")
+async def sales_timeseries(
+    bucket: str = Query("month", pattern="^(day|week|month)$"),
+    points: int = Query(500, ge=3, le=10000, description="Maximum number of points returned"),
+    metric: str = Query("sales", pattern=f"^({'|'.join(METRICS)})$", description="Series kept by the downsampling"),
+    filters: OrderFilters = Depends(order_filters),
+    source: str = SOURCE
+):
+    pipeline = timeseries_pipeline(bucket)
+    result = await aggregate(f'sales_timeseries_{bucket}', pipeline, filters, source,
+                             cube_pipeline=timeseries_pipeline(bucket, **CUBE_MEASURES))
+    # The full series is cached, long ranges are downsampled per request
+    return lttb(result, points, y=metric)
+
+# Years present in Orders with their first/last order date and order count.
+# Each year is found by seeking the `Order Date` index past the end of the
+# previous one, so the cost grows with the number of years, not of orders
+def year_index():
+    years = []
+    dated = {'Order Date': {'$type': 'date'}}
+    first = db.Orders.find_one(dated, {'Order Date': 1}, sort=[('Order Date', 1)])
+    while first:
+        year = first['Order Date'].year
+        end = datetime(year + 1, 1, 1)
+        in_year = {'Order Date': {'$gte': datetime(year, 1, 1), '$lt': end}}
+        last = db.Orders.find_one(in_year, {'Order Date': 1}, sort=[('Order Date', -1)])
+        years.append({
+            'year': year,
+            'orders': db.Orders.count_documents(in_year),
+            'firstOrderDate': first['Order Date'],
+            'lastOrderDate': last['Order Date']
+        })
+        first = db.Orders.find_one({'Order Date': {'$gte': end}}, {'Order Date': 1}, sort=[('Order Date', 1)])
+    return years
+
+async def cached_year_index():
+    found, years = result_cache.get(('year_index',))
+    if not found:
+        years = await run_in_threadpool(year_index)
+        result_cache.set(('year_index',), years)
+    return years
+
 @app.get("/years")
-def get_years():
-    years = db.Orders.distinct("Order Date")
-    unique_years = sorted(set([d.year for d in years]))
+async def get_years():
+    unique_years = [row['year'] for row in await cached_year_index()]
     return unique_years
 
+@app.get("/years/stats")
+async def get_year_stats():
+    return await cached_year_index()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return dict(result_cache.stats(), singleFlight=in_flight.stats())
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get("/columnar/stats")
+async def columnar_stats():
+    return columnar_engine.stats()
+
+def route_handler(endpoint):
+    return next((route.endpoint for route in app.routes if getattr(route, 'path', None) == f"/{endpoint}"), None)
+
+# Call an endpoint handler with the given parameters and the defaults of the others
+async def call_handler(handler, values):
+    arguments = {
+        name: values.get(name, getattr(parameter.default, 'default', parameter.default))
+        for name, parameter in inspect.signature(handler).parameters.items()
+    }
+    return await handler(**arguments)
+
+# Endpoints the cache warmer precomputes for all years and for each year, with
+# the defaults of their other parameters
+WARMED_ENDPOINTS = [
+    'total_sales', 'total_profits', 'total_orders', 'average_sales', 'total_quantity', 'total_client', 'kpis',
+    'ship_mode', 'average_per_ship_mode', 'quantity_by_category', 'category_by_segment',
+    'total_orders_by_segment', 'revenue_by_segment', 'total_orders_by_category', 'revenue_by_category',
+    'average_orders_by_customers'
+]
+
+async def warm_endpoint(endpoint, year):
+    token = warming.set(True)
+    labels = metrics.request_labels.set({'endpoint': 'cache_warmer', 'year': year or 'all'})
+    try:
+        await call_handler(route_handler(endpoint), {'filters': OrderFilters(year=year)})
+    finally:
+        metrics.request_labels.reset(labels)
+        warming.reset(token)
+
+# Share of the result cache the warmed results may fill, so that a warming
+# run neither evicts its own results nor crowds out the other requests
+CACHE_WARM_SHARE = 0.5
+
+# Each warmed endpoint x year takes about one cache entry: all years are
+# warmed, then the most recent ones, as many as fit in the warm share. Nothing
+# is warmed when even all years do not fit
+async def warm_jobs():
+    # Warming runs outside any request, so it polls the data version itself
+    await run_in_threadpool(result_cache.check_version)
+    fitting = int(result_cache.maxsize * CACHE_WARM_SHARE) // len(WARMED_ENDPOINTS)
+    if not fitting:
+        return {}
+    years = [row['year'] for row in await cached_year_index()]
+    years = [None] + years[::-1][:fitting - 1]
+    return {
+        f"{endpoint}?year={year}" if year else endpoint: functools.partial(warm_endpoint, endpoint, year)
+        for endpoint in WARMED_ENDPOINTS for year in years
+    }
+
+# Recomputes every endpoint x year at start-up and every CACHE_WARM_INTERVAL
+# seconds (0 disables it), so that with the stale results no dashboard request
+# waits on a cold aggregation
+cache_warmer = CacheWarmer(warm_jobs, interval=int(os.environ.get("CACHE_WARM_INTERVAL", 300)))
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return {name: limiter.stats() for name, limiter in admission.LIMITERS.items()}
+
+@app.get("/cache/warmer")
+async def cache_warmer_stats():
+    return cache_warmer.stats()
+
+@app.get("/debug/explain/{endpoint}")
+async def explain(endpoint: str, filters: OrderFilters = Depends(order_filters), source: str = SOURCE):
+    handler = route_handler(endpoint)
+    if handler is None:
+        raise HTTPException(status_code=404, detail=f"Unknown endpoint {endpoint}")
+    token = capture_pipeline.set(True)
+    try:
+        # Explain the exact pipeline, never the shortcut of the sketches
+        await call_handler(handler, {'filters': filters, 'source': source, 'exact': True})
+    except CapturedPipeline as captured:
+        command = {'aggregate': captured.collection, 'pipeline': captured.pipeline, 'cursor': {}}
+    else:
+        raise HTTPException(status_code=400, detail=f"{endpoint} does not run an aggregation pipeline")
+    finally:
+        capture_pipeline.reset(token)
+    start = time.perf_counter()
+    plan = await run_in_threadpool(db.command, 'explain', command, verbosity='executionStats')
+    summary = explain_summary(plan)
+    summary['wallTimeMillis'] = round((time.perf_counter() - start) * 1000, 1)
+    summary['collection'] = command['aggregate']
+    summary['pipeline'] = command['pipeline']
+    return summary
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
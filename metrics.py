@@ -0,0 +1,161 @@
+import threading
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+# Labels of the request being served, and the pipelines it ran as
+# (name, collection, pipeline) so that the slow-request log can show them
+request_labels = ContextVar('request_labels', default=None)
+request_pipelines = ContextVar('request_pipelines', default=None)
+# Name of the pipeline being run, the label of the Mongo commands it sends
+current_pipeline = ContextVar('current_pipeline', default=None)
+
+# Years labelled as such; any other value of the year parameter is labelled
+# 'invalid', which bounds the number of series
+LABELLED_YEARS = range(1900, 2101)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+DOCUMENTS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Prometheus histogram with labels, rendered in the text exposition format."""
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.series[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self.series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            labels = ','.join(f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key))
+            prefix = f"{labels}," if labels else ''
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return '\n'.join(lines)
+
+
+class Counter:
+    """Prometheus counter with labels."""
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for key, value in sorted(series.items()):
+            labels = ','.join(f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return '\n'.join(lines)
+
+
+REQUEST_SECONDS = Histogram(
+    'api_request_duration_seconds', 'Time to answer a request, body sent included.',
+    ('endpoint', 'year', 'status'), LATENCY_BUCKETS
+)
+RESPONSE_BYTES = Histogram(
+    'api_response_bytes', 'Bytes of the response body, after compression.', ('endpoint', 'year'), BYTES_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    'api_serialization_duration_seconds', 'Time to encode and compress a response body.',
+    ('endpoint', 'year', 'format'), LATENCY_BUCKETS
+)
+MONGO_SECONDS = Histogram(
+    'mongo_command_duration_seconds', 'Round trip of the Mongo commands, per pipeline.',
+    ('endpoint', 'year', 'pipeline', 'command'), LATENCY_BUCKETS
+)
+MONGO_DOCUMENTS = Histogram(
+    'mongo_documents_returned', 'Documents returned by a Mongo command batch, per pipeline.',
+    ('endpoint', 'year', 'pipeline', 'command'), DOCUMENTS_BUCKETS
+)
+HISTOGRAMS = [REQUEST_SECONDS, RESPONSE_BYTES, SERIALIZATION_SECONDS, MONGO_SECONDS, MONGO_DOCUMENTS]
+COALESCED_REQUESTS = Counter(
+    'api_coalesced_requests_total', 'Requests served by the pipeline run of an identical request in flight.',
+    ('endpoint', 'year')
+)
+SHED_REQUESTS = Counter(
+    'api_shed_requests_total', 'Requests answered 503 because their query class was at its concurrency limit.',
+    ('endpoint', 'year', 'class')
+)
+COUNTERS = [COALESCED_REQUESTS, SHED_REQUESTS]
+
+
+def year_label(value):
+    """Label of the `year` query parameter: the year when it is one that
+    OrderFilters accepts and within LABELLED_YEARS, 'all' without it."""
+    if value is None:
+        return 'all'
+    try:
+        year = int(value)
+    except ValueError:
+        return 'invalid'
+    return str(year) if year in LABELLED_YEARS else 'invalid'
+
+
+def render():
+    return '\n'.join(metric.render() for metric in HISTOGRAMS + COUNTERS) + '\n'
+
+
+def observe(histogram, value, **labels):
+    """Observe with the labels of the current request, if any."""
+    histogram.observe(value, **(request_labels.get() or {}), **labels)
+
+
+def increment(counter, amount=1, **labels):
+    """Increment with the labels of the current request, if any."""
+    counter.inc(amount, **(request_labels.get() or {}), **labels)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Duration and returned documents of every command, labelled with the
+    request and the pipeline that sent it. The listener runs in the thread or
+    task of the command, where the context variables of the request are set."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        labels = {'pipeline': current_pipeline.get() or '', 'command': event.command_name}
+        observe(MONGO_SECONDS, event.duration_micros / 1e6, **labels)
+        cursor = event.reply.get('cursor') if isinstance(event.reply, dict) else None
+        if cursor:
+            batch = cursor.get('firstBatch', cursor.get('nextBatch', []))
+            observe(MONGO_DOCUMENTS, len(batch), **labels)
+
+    def failed(self, event):
+        labels = {'pipeline': current_pipeline.get() or '', 'command': event.command_name}
+        observe(MONGO_SECONDS, event.duration_micros / 1e6, **labels)
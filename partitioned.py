@@ -0,0 +1,206 @@
+"""Partitioned execution of the aggregations over all of Orders.
+
+A single aggregation runs on one server thread, however large Orders is. In
+this mode the `Order Date` range is cut into partitions. The partial `$group`
+of each partition runs concurrently on its own pooled connection, and the
+partial groups are merged: sums and counts are added, and minimums and maximums
+compared. Whatever is not additive is only derived from the merged groups.
+That includes averages, recomputed as sum / count, counts of distinct
+customers, and the top category of each segment.
+"""
+from datetime import datetime, timedelta
+
+from timeseries import timeseries_pipeline
+
+
+def _least(a, b):
+    return b if a is None or (b is not None and b < a) else a
+
+
+def _greatest(a, b):
+    return b if a is None or (b is not None and b > a) else a
+
+
+# How two partial values of an accumulator combine; accumulators such as
+# $avg are not mergeable and have no place in a partial $group
+COMBINE = {
+    '$sum': lambda a, b: a + b,
+    '$min': _least,
+    '$max': _greatest
+}
+
+
+def _key(value):
+    return tuple(value.items()) if isinstance(value, dict) else value
+
+
+def merge(rows, group):
+    """Merge the partial rows of a `$group` stage: the rows of the same `_id`
+    are combined field by field with the accumulator of the field."""
+    accumulators = {field: next(iter(spec)) for field, spec in group['$group'].items() if field != '_id'}
+    merged = {}
+    for row in rows:
+        key = _key(row['_id'])
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+        total = merged[key]
+        for field, accumulator in accumulators.items():
+            total[field] = COMBINE[accumulator](total.get(field), row.get(field))
+    return list(merged.values())
+
+
+def partition_predicates(low, high, count, field='Order Date'):
+    """`$match` predicates cutting [low, high) into `count` ranges of whole days.
+
+    The first range is open below and the last one above, so together they
+    match every order, including those without a date. Empty when the range
+    spans fewer than `count` days.
+    """
+    days = (high - low).days
+    if count < 2 or days < count:
+        return []
+    start = datetime(low.year, low.month, low.day)
+    cuts = [start + timedelta(days=days * i // count) for i in range(1, count)]
+    predicates = [{field: {'$not': {'$gte': cuts[0]}}}]
+    predicates += [{field: {'$gte': cut, '$lt': following}} for cut, following in zip(cuts, cuts[1:])]
+    predicates.append({field: {'$gte': cuts[-1]}})
+    return predicates
+
+
+def _rows(rows):
+    return rows
+
+
+def _renamed(field, output):
+    def reduce(rows):
+        return [{field: row['_id'], output: row[output]} for row in rows]
+    return reduce
+
+
+def _total_orders(rows):
+    return [{'Order ID': row['Order ID']} for row in rows]
+
+
+def _average_sales(rows):
+    return [{'averageSalesPerOrder': row['totalSales'] / row['orderCount']} for row in rows]
+
+
+def _total_client(rows):
+    return [{'Customers ID': len(rows)}] if rows else []
+
+
+def _kpis(rows):
+    if not rows:
+        return []
+    orders = sum(row['orderCount'] for row in rows)
+    return [{
+        'totalSales': sum(row['sales'] for row in rows),
+        'totalProfit': sum(row['profit'] for row in rows),
+        'totalOrders': orders,
+        'totalQuantity': sum(row['quantity'] for row in rows),
+        'totalClients': len(rows),
+        'averageOrdersPerCustomer': orders / len(rows)
+    }]
+
+
+def _kpis_by_year(rows):
+    years = {}
+    for row in rows:
+        years.setdefault(row['_id'].get('year'), []).append(row)
+    return [dict(_kpis(customers)[0], year=year) for year, customers in years.items()]
+
+
+def _average_orders_by_customers(rows):
+    if not rows:
+        return []
+    return [{'_id': None, 'averageOrdersPerCustomer': sum(row['orderCount'] for row in rows) / len(rows)}]
+
+
+def _ship_mode(rows):
+    return sorted(rows, key=lambda row: row['totalOrders'])
+
+
+def _average_per_ship_mode(rows):
+    return [{
+        '_id': row['_id'],
+        'AverageDaysDifference': round(row['days'] / row['shipped'], 1) if row['shipped'] else None
+    } for row in rows]
+
+
+def _retention(rows):
+    result = []
+    for row in rows:
+        if row['orderCount'] <= 1:
+            continue
+        first, last = row['firstOrderDate'], row['lastOrderDate']
+        # Milliseconds over milliseconds per day, like the $subtract / $divide
+        # of the single pipeline
+        days = (last - first) / timedelta(milliseconds=1) / 86400000 if first and last else None
+        result.append(dict(row, **{'Customer Name': row['_id'], 'retentionPeriodDays': days}))
+    return result
+
+
+def _series(rows):
+    rows = sorted((row for row in rows if row['_id'] is not None), key=lambda row: row['_id'])
+    return [{'date': row.pop('_id'), **row} for row in rows]
+
+
+def _group(key, **accumulators):
+    return {'$group': dict(accumulators, _id=key)}
+
+
+SHIP_DAYS = {'$dateDiff': {'startDate': '$Order Date', 'endDate': '$Ship Date', 'unit': 'day'}}
+CUSTOMER_MEASURES = {
+    'sales': {'$sum': '$Sales'},
+    'profit': {'$sum': '$Profit'},
+    'quantity': {'$sum': '$Quantity'},
+    'orderCount': {'$sum': 1}
+}
+
+# Endpoints of main.py that can run partitioned: (partial stages ending with a
+# mergeable $group, function turning the merged groups into the documents of
+# the single pipeline). The post-processing of aggregate(), e.g. the fold into
+# categories, then applies as usual
+PLANS = {
+    'total_sales': ([_group(None, totalSales={'$sum': '$Sales'})], _rows),
+    'total_profits': ([_group(None, totalProfit={'$sum': '$Profit'})], _rows),
+    'total_quantity': ([_group(None, totalQuantity={'$sum': '$Quantity'})], _rows),
+    'total_orders': ([_group(None, **{'Order ID': {'$sum': 1}})], _total_orders),
+    'average_sales': ([_group(None, totalSales={'$sum': '$Sales'}, orderCount={'$sum': 1})], _average_sales),
+    'total_client': ([_group('$Customer ID')], _total_client),
+    'kpis': ([_group('$Customer ID', **CUSTOMER_MEASURES)], _kpis),
+    'kpis_by_year': (
+        [_group({'year': {'$year': '$Order Date'}, 'customer': '$Customer ID'}, **CUSTOMER_MEASURES)],
+        _kpis_by_year
+    ),
+    'average_orders_by_customers': ([_group('$Customer ID', orderCount={'$sum': 1})], _average_orders_by_customers),
+    'ship_mode': ([_group('$Ship Mode', totalOrders={'$sum': 1})], _ship_mode),
+    'average_per_ship_mode': (
+        # $avg skips the orders not shipped, so they are not counted either
+        [_group('$Ship Mode', days={'$sum': SHIP_DAYS},
+                shipped={'$sum': {'$cond': [{'$eq': [SHIP_DAYS, None]}, 0, 1]}})],
+        _average_per_ship_mode
+    ),
+    'quantity_by_category': ([_group('$Product ID', totalQuantity={'$sum': '$Quantity'})], _rows),
+    'total_orders_by_category': ([_group('$Product ID', totalOrders={'$sum': 1})], _rows),
+    'revenue_by_category': ([_group('$Product ID', totalSales={'$sum': '$Sales'})], _rows),
+    # The counts per segment x product are merged before the top category of
+    # each segment is picked, never the top categories of the partitions
+    'category_by_segment': (
+        [_group({'Segment': '$Segment', 'Product ID': '$Product ID'}, TotalOrders={'$sum': 1})], _rows
+    ),
+    'total_orders_by_segment': ([_group('$Segment', TotalOrders={'$sum': 1})], _renamed('Segment', 'TotalOrders')),
+    'revenue_by_segment': ([_group('$Segment', totalRevenue={'$sum': '$Sales'})], _renamed('Segment', 'totalRevenue')),
+    # Each partition joins its customers and groups them by name; first and
+    # last order dates merge as min / max
+    'retention_by_customers': ([
+        _group('$Customer ID', firstOrderDate={'$min': '$Order Date'}, lastOrderDate={'$max': '$Order Date'},
+               orderCount={'$sum': 1}),
+        {'$lookup': {'from': 'Customers', 'localField': '_id', 'foreignField': 'Customer ID', 'as': 'CustomerDetails'}},
+        {'$unwind': '$CustomerDetails'},
+        _group('$CustomerDetails.Customer Name', firstOrderDate={'$min': '$firstOrderDate'},
+               lastOrderDate={'$max': '$lastOrderDate'}, orderCount={'$sum': '$orderCount'})
+    ], _retention),
+    **{f'sales_timeseries_{bucket}': (timeseries_pipeline(bucket)[:1], _series) for bucket in ('day', 'week', 'month')}
+}
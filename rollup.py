@@ -0,0 +1,220 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+
+from cache import bump_data_version, data_version
+from dimensions import CATEGORY_LOOKUP
+from sketches import refresh_customer_sketches, refresh_value_sketches, stamp_sketches
+
+# Materialized daily rollup of Orders, one row per
+# day x Segment x Category x Ship Mode
+CUBE_COLLECTION = 'OrdersDaily'
+# Per-day fingerprint of Orders as of the last refresh
+STATE_COLLECTION = 'OrdersDailyState'
+
+DAY = {'$dateTrunc': {'date': '$Order Date', 'unit': 'day'}}
+
+
+def day_fingerprints(db, since=None):
+    """Count and sums of Orders per day, used to detect the days that changed.
+
+    Orders without an Order Date belong to no day, so the cube and sketches
+    never hold them.
+    """
+    match = {'Order Date': {'$type': 'date', '$gte': since} if since else {'$type': 'date'}}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': DAY,
+            'orders': {'$sum': 1},
+            'sales': {'$sum': '$Sales'},
+            'profit': {'$sum': '$Profit'},
+            'quantity': {'$sum': '$Quantity'}
+        }}
+    ]
+    return {row.pop('_id'): row for row in db.Orders.aggregate(pipeline)}
+
+
+def changed_days(db, since=None):
+    current = day_fingerprints(db, since)
+    query = {'_id': {'$gte': since}} if since else {}
+    stored = {row.pop('_id'): row for row in db[STATE_COLLECTION].find(query)}
+    changed = {day for day, row in current.items() if stored.get(day) != row}
+    # Days that no longer have any order must be emptied too
+    changed |= set(stored) - set(current)
+    return sorted(changed), current
+
+
+def rollup_pipeline(days):
+    return [
+        {'$match': {'$or': [
+            {'Order Date': {'$gte': day, '$lt': day + timedelta(days=1)}}
+            for day in days
+        ]}},
+        CATEGORY_LOOKUP,
+        # Orders without a matching product are kept with a null Category so
+        # that the totals stay identical to the raw Orders pipelines
+        {'$unwind': {'path': '$ProductDetails', 'preserveNullAndEmptyArrays': True}},
+        {'$group': {
+            '_id': {
+                'day': DAY,
+                'Segment': '$Segment',
+                'Category': '$ProductDetails.Category',
+                'Ship Mode': '$Ship Mode'
+            },
+            'sales': {'$sum': '$Sales'},
+            'profit': {'$sum': '$Profit'},
+            'quantity': {'$sum': '$Quantity'},
+            'orders': {'$sum': 1},
+            'shipDays': {'$sum': {'$dateDiff': {
+                'startDate': '$Order Date', 'endDate': '$Ship Date', 'unit': 'day'
+            }}},
+            'shippedOrders': {'$sum': {'$cond': [{'$ifNull': ['$Ship Date', False]}, 1, 0]}}
+        }},
+        {'$project': {
+            '_id': 0,
+            'day': '$_id.day',
+            'Segment': '$_id.Segment',
+            'Category': '$_id.Category',
+            'Ship Mode': '$_id.Ship Mode',
+            'sales': 1,
+            'profit': 1,
+            'quantity': 1,
+            'orders': 1,
+            'shipDays': 1,
+            'shippedOrders': 1
+        }}
+    ]
+
+
+def mark_days_dirty(db, dates):
+    """Force the days of the given dates to be rebuilt on the next refresh.
+
+    Writers that update orders in place without changing their counts or sums
+    must call this, since the fingerprint cannot see such edits.
+    """
+    days = {datetime(d.year, d.month, d.day) for d in dates}
+    db[STATE_COLLECTION].delete_many({'_id': {'$in': list(days)}})
+
+
+def refresh_rollup(db, since=None, batch_days=31, rebuild=False):
+    """Rebuild the cube rows, customer sketches and value sketches of the days
+    whose orders changed since the last refresh, or of every day with `rebuild`."""
+    if rebuild:
+        # Stored fingerprints no longer match any day, which also keeps the
+        # days left without orders to be emptied
+        db[STATE_COLLECTION].update_many({'_id': {'$gte': since}} if since else {}, {'$set': {'rebuild': True}})
+    # Orders written from here on may be missed by this refresh
+    version = data_version(db)
+    days, fingerprints = changed_days(db, since)
+    cube = db[CUBE_COLLECTION]
+    state = db[STATE_COLLECTION]
+    for i in range(0, len(days), batch_days):
+        batch = days[i:i + batch_days]
+        rows = list(db.Orders.aggregate(rollup_pipeline(batch)))
+        cube.delete_many({'day': {'$in': batch}})
+        if rows:
+            cube.insert_many(rows, ordered=False)
+        refresh_customer_sketches(db, batch)
+        refresh_value_sketches(db, batch)
+        state.delete_many({'_id': {'$in': batch}})
+        states = [dict(fingerprints[day], _id=day) for day in batch if day in fingerprints]
+        if states:
+            state.insert_many(states, ordered=False)
+    if days and bump_data_version(db) == version + 1:
+        # No other writer bumped the version meanwhile
+        version += 1
+    if since is None:
+        # Only a refresh checking every day vouches for all the sketches
+        stamp_sketches(db, version)
+    return days
+
+
+def _by_category(field, output):
+    return [
+        {'$match': {'Category': {'$ne': None}}},
+        {'$group': {'_id': '$Category', output: {'$sum': field}}},
+        {'$project': {'Category': '$_id', output: 1, '_id': 0}}
+    ]
+
+
+def _by_segment(field, output):
+    return [
+        {'$group': {'_id': '$Segment', output: {'$sum': field}}},
+        {'$project': {'_id': 0, 'Segment': '$_id', output: 1}}
+    ]
+
+
+# Cube equivalents of the Orders pipelines in main.py, producing the same
+# output documents
+CUBE_PIPELINES = {
+    'total_sales': [
+        {'$group': {'_id': None, 'totalSales': {'$sum': '$sales'}}}
+    ],
+    'total_profits': [
+        {'$group': {'_id': None, 'totalProfit': {'$sum': '$profit'}}}
+    ],
+    'total_orders': [
+        {'$group': {'_id': None, 'count': {'$sum': '$orders'}}},
+        {'$project': {'_id': 0, 'Order ID': '$count'}}
+    ],
+    'average_sales': [
+        {'$group': {
+            '_id': None,
+            'totalSales': {'$sum': '$sales'},
+            'orderCount': {'$sum': '$orders'}
+        }},
+        {'$project': {
+            '_id': 0,
+            'averageSalesPerOrder': {'$divide': ['$totalSales', '$orderCount']}
+        }}
+    ],
+    'total_quantity': [
+        {'$group': {'_id': None, 'totalQuantity': {'$sum': '$quantity'}}}
+    ],
+    'ship_mode': [
+        {'$group': {'_id': '$Ship Mode', 'totalOrders': {'$sum': '$orders'}}},
+        {'$sort': {'totalOrders': 1}}
+    ],
+    'average_per_ship_mode': [
+        {'$group': {
+            '_id': '$Ship Mode',
+            'shipDays': {'$sum': '$shipDays'},
+            'shippedOrders': {'$sum': '$shippedOrders'}
+        }},
+        {'$project': {
+            '_id': 1,
+            'AverageDaysDifference': {'$cond': [
+                {'$gt': ['$shippedOrders', 0]},
+                {'$round': [{'$divide': ['$shipDays', '$shippedOrders']}, 1]},
+                None
+            ]}
+        }}
+    ],
+    'quantity_by_category': _by_category('$quantity', 'totalQuantity'),
+    'total_orders_by_category': _by_category('$orders', 'totalOrders'),
+    'revenue_by_category': _by_category('$sales', 'totalSales'),
+    'total_orders_by_segment': _by_segment('$orders', 'TotalOrders'),
+    'revenue_by_segment': _by_segment('$sales', 'totalRevenue'),
+    'category_by_segment': [
+        {'$match': {'Category': {'$ne': None}}},
+        {'$group': {
+            '_id': {'Segment': '$Segment', 'Category': '$Category'},
+            'TotalOrders': {'$sum': '$orders'}
+        }},
+        {'$sort': {'_id.Segment': 1, 'TotalOrders': -1}},
+        {'$group': {'_id': '$_id.Segment', 'TopCategory': {'$first': '$_id.Category'}}},
+        {'$project': {'_id': 0, 'Segment': '$_id', 'TopCategory': 1}}
+    ]
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the daily rollup cube and sketches of Orders")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild every day, not only the changed ones")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    refreshed = refresh_rollup(MongoClient(args.mongo_url)[args.database], rebuild=args.rebuild)
+    print(f"{len(refreshed)} day(s) refreshed in {CUBE_COLLECTION}")
@@ -0,0 +1,211 @@
+import argparse
+import os
+from datetime import datetime, timezone
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cache import META_COLLECTION, bump_data_version
+from dimensions import ProductDimension
+from indexes import INDEXES
+from leadtime import lead_time
+
+# Running aggregates of Orders, one document per year (None for all time) x
+# breakdown (None for the totals, or Segment, Category, Ship Mode) x value,
+# kept exact by $inc upserts as orders are ingested
+RUNNING_COLLECTION = 'RunningTotals'
+MEASURES = ('sales', 'profit', 'quantity', 'orders', 'shipDays', 'shippedOrders')
+# Marker of the Meta collection set by the first rebuild: before it, the
+# running aggregates only hold the orders posted since they were created
+RUNNING_BUILT_ID = 'runningTotalsBuilt'
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def order_rows(orders):
+    """Orders in the shape of the rows of rebuild_pipeline, one per order."""
+    rows = []
+    for order in orders:
+        order_date = order.get('Order Date')
+        days = lead_time(order_date, order.get('Ship Date'))
+        rows.append({
+            'year': order_date.year if isinstance(order_date, datetime) else None,
+            'Segment': order.get('Segment'),
+            'Ship Mode': order.get('Ship Mode'),
+            'Product ID': order.get('Product ID'),
+            'sales': _number(order.get('Sales')),
+            'profit': _number(order.get('Profit')),
+            'quantity': _number(order.get('Quantity')),
+            'orders': 1,
+            'shipDays': days if days is not None else 0,
+            'shippedOrders': 1 if days is not None else 0
+        })
+    return rows
+
+
+def fold(rows, products):
+    """Increments of the running aggregates for rows grouped by year, Segment,
+    Ship Mode and Product ID. `products` is the map of the products dimension,
+    which holds one product per Product ID, so an order counts once in the
+    Category breakdown, like in the category endpoints and the rollup cube."""
+    increments = {}
+    for row in rows:
+        years = (None, row['year']) if row['year'] is not None else (None,)
+        keys = [(None, None)] + [(by, row[by]) for by in ('Segment', 'Ship Mode')]
+        keys += [('Category', product.get('Category')) for product in products.get(row['Product ID'], [])]
+        for year in years:
+            for by, value in keys:
+                total = increments.setdefault((year, by, value), dict.fromkeys(MEASURES, 0))
+                for measure in MEASURES:
+                    total[measure] += row[measure]
+    return increments
+
+
+def apply_increments(db, increments):
+    if not increments:
+        return
+    db[RUNNING_COLLECTION].bulk_write([
+        UpdateOne({'year': year, 'by': by, 'value': value}, {'$inc': measures}, upsert=True)
+        for (year, by, value), measures in increments.items()
+    ], ordered=False)
+
+
+def insert_orders(db, orders, products):
+    """Insert the orders unordered and add the inserted ones to the running
+    aggregates. Returns the number inserted and the write errors."""
+    if not orders:
+        return 0, []
+    errors = []
+    try:
+        db.Orders.insert_many(orders, ordered=False)
+    except BulkWriteError as e:
+        errors = [{'index': error['index'], 'message': error.get('errmsg')} for error in e.details['writeErrors']]
+    failed = {error['index'] for error in errors}
+    inserted = [order for i, order in enumerate(orders) if i not in failed]
+    apply_increments(db, fold(order_rows(inserted), products))
+    if inserted:
+        bump_data_version(db)
+    return len(inserted), errors
+
+
+def rebuild_pipeline():
+    return [
+        {'$group': {
+            '_id': {
+                'year': {'$year': '$Order Date'},
+                'Segment': '$Segment',
+                'Ship Mode': '$Ship Mode',
+                'Product ID': '$Product ID'
+            },
+            'sales': {'$sum': '$Sales'},
+            'profit': {'$sum': '$Profit'},
+            'quantity': {'$sum': '$Quantity'},
+            'orders': {'$sum': 1},
+            'shipDays': {'$sum': {'$dateDiff': {
+                'startDate': '$Order Date', 'endDate': '$Ship Date', 'unit': 'day'
+            }}},
+            'shippedOrders': {'$sum': {'$cond': [{'$ifNull': ['$Ship Date', False]}, 1, 0]}}
+        }}
+    ]
+
+
+def rebuild_running_totals(db, products):
+    """Recompute the running aggregates from Orders, e.g. after writes made
+    outside POST /orders, and swap them in at once."""
+    rows = [dict(row.pop('_id'), **row) for row in db.Orders.aggregate(rebuild_pipeline(), allowDiskUse=True)]
+    staging = db[RUNNING_COLLECTION + 'Staging']
+    staging.drop()
+    docs = [dict(measures, year=year, by=by, value=value)
+            for (year, by, value), measures in fold(rows, products).items()]
+    if docs:
+        staging.insert_many(docs, ordered=False)
+        staging.create_indexes(INDEXES[RUNNING_COLLECTION])
+        staging.rename(RUNNING_COLLECTION, dropTarget=True)
+    else:
+        db[RUNNING_COLLECTION].delete_many({})
+    db[META_COLLECTION].update_one({'_id': RUNNING_BUILT_ID}, {'$set': {'builtAt': datetime.now(timezone.utc)}}, upsert=True)
+    bump_data_version(db)
+    return len(docs)
+
+
+def running_built(db):
+    """Whether the running aggregates were rebuilt from Orders at least once."""
+    return db[META_COLLECTION].find_one({'_id': RUNNING_BUILT_ID}) is not None
+
+
+def _breakdown(db, year, by):
+    return {doc['value']: doc for doc in db[RUNNING_COLLECTION].find({'year': year, 'by': by}, {'_id': 0})}
+
+
+def _total(output, measure):
+    def query(db, year):
+        total = _breakdown(db, year, None).get(None)
+        return [{'_id': None, output: total[measure]}] if total and total['orders'] else []
+    return query
+
+
+def _by(by, output, measure):
+    def query(db, year):
+        return [{by: value, output: doc[measure]} for value, doc in _breakdown(db, year, by).items() if doc['orders']]
+    return query
+
+
+def total_orders(db, year):
+    total = _breakdown(db, year, None).get(None)
+    return [{'Order ID': total['orders']}] if total and total['orders'] else []
+
+
+def average_sales(db, year):
+    total = _breakdown(db, year, None).get(None)
+    return [{'averageSalesPerOrder': total['sales'] / total['orders']}] if total and total['orders'] else []
+
+
+def ship_mode(db, year):
+    rows = [{'_id': mode, 'totalOrders': doc['orders']} for mode, doc in _breakdown(db, year, 'Ship Mode').items()
+            if doc['orders']]
+    return sorted(rows, key=lambda row: row['totalOrders'])
+
+
+def average_per_ship_mode(db, year):
+    return [{
+        '_id': mode,
+        'AverageDaysDifference': round(doc['shipDays'] / doc['shippedOrders'], 1) if doc['shippedOrders'] else None
+    } for mode, doc in _breakdown(db, year, 'Ship Mode').items() if doc['orders']]
+
+
+# Endpoints of main.py answered from the running aggregates, by index lookups
+# of a handful of documents: (db, year or None) -> documents
+RUNNING_QUERIES = {
+    'total_sales': _total('totalSales', 'sales'),
+    'total_profits': _total('totalProfit', 'profit'),
+    'total_quantity': _total('totalQuantity', 'quantity'),
+    'total_orders': total_orders,
+    'average_sales': average_sales,
+    'ship_mode': ship_mode,
+    'average_per_ship_mode': average_per_ship_mode,
+    'revenue_by_segment': _by('Segment', 'totalRevenue', 'sales'),
+    'total_orders_by_segment': _by('Segment', 'TotalOrders', 'orders'),
+    'revenue_by_category': _by('Category', 'totalSales', 'sales'),
+    'total_orders_by_category': _by('Category', 'totalOrders', 'orders'),
+    'quantity_by_category': _by('Category', 'totalQuantity', 'quantity')
+}
+
+
+def query(db, endpoint, year):
+    """Documents of `endpoint` from the running aggregates, None while they
+    were never rebuilt from Orders."""
+    if not running_built(db):
+        return None
+    return RUNNING_QUERIES[endpoint](db, year)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the running aggregates from Orders")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB", "ecommerce"))
+    args = parser.parse_args()
+    db = MongoClient(args.mongo_url)[args.database]
+    count = rebuild_running_totals(db, ProductDimension(db).lookup())
+    print(f"{count} running aggregate(s) rebuilt in {RUNNING_COLLECTION}")
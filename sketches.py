@@ -0,0 +1,246 @@
+import hashlib
+from datetime import timedelta
+
+import numpy as np
+from bson import Binary
+
+from cache import META_COLLECTION, data_version
+from dimensions import CATEGORY_LOOKUP
+
+# HyperLogLog sketches of the distinct Customer IDs of each day x Segment
+CUSTOMER_SKETCHES = 'CustomerSketches'
+# t-digests of the Sales and Profit of the orders of each day x Segment x Category
+VALUE_SKETCHES = 'ValueSketches'
+VALUE_MEASURES = {'sales': '$Sales', 'profit': '$Profit'}
+
+# Data version the sketches were last refreshed at, in the Meta collection
+SKETCHES_VERSION_ID = 'sketchesVersion'
+
+DAY = {'$dateTrunc': {'date': '$Order Date', 'unit': 'day'}}
+
+
+class HyperLogLog:
+    """Fixed-memory distinct counter: 2**precision one-byte registers, ~1.04/sqrt(2**precision)
+    standard error (1.6% with the default precision), mergeable by register-wise max."""
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = np.zeros(self.size, dtype=np.uint8)
+        else:
+            self.registers = np.frombuffer(registers, dtype=np.uint8).copy()
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * self.size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.size * np.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_binary(self):
+        return Binary(self.registers.tobytes())
+
+
+def refresh_customer_sketches(db, days, precision=12):
+    """Rebuild the customer sketches of the given days (midnight datetimes)."""
+    pipeline = [
+        {'$match': {'$or': [
+            {'Order Date': {'$gte': day, '$lt': day + timedelta(days=1)}}
+            for day in days
+        ]}},
+        {'$group': {
+            '_id': {'day': DAY, 'Segment': '$Segment'},
+            'customers': {'$addToSet': '$Customer ID'}
+        }}
+    ]
+    sketches = []
+    for row in db.Orders.aggregate(pipeline):
+        sketch = HyperLogLog(precision)
+        for customer in row['customers']:
+            sketch.add(customer)
+        sketches.append({
+            'day': row['_id']['day'],
+            'Segment': row['_id']['Segment'],
+            'precision': precision,
+            'registers': sketch.to_binary()
+        })
+    db[CUSTOMER_SKETCHES].delete_many({'day': {'$in': days}})
+    if sketches:
+        db[CUSTOMER_SKETCHES].insert_many(sketches, ordered=False)
+
+
+def stamp_sketches(db, version):
+    """Record that the sketches reflect the data as of `version`."""
+    db[META_COLLECTION].update_one({'_id': SKETCHES_VERSION_ID}, {'$set': {'version': version}}, upsert=True)
+
+
+def sketches_current(db):
+    """Whether no write happened since the sketches were last refreshed."""
+    doc = db[META_COLLECTION].find_one({'_id': SKETCHES_VERSION_ID})
+    return doc is not None and doc['version'] >= data_version(db)
+
+
+def merged_customer_sketch(db, match):
+    """Union of the sketches matching `match` (on day and Segment), None if there
+    are none or if orders were written since they were refreshed."""
+    if not sketches_current(db):
+        return None
+    merged = None
+    for doc in db[CUSTOMER_SKETCHES].find(match or {}, {'_id': 0, 'precision': 1, 'registers': 1}):
+        sketch = HyperLogLog(doc['precision'], doc['registers'])
+        merged = sketch if merged is None else merged.merge(sketch)
+    return merged
+
+
+class TDigest:
+    """Mergeable quantile sketch: the values are summarized by centroids
+    (mean, weight). Centroids are small near the tails and large around the
+    median, so extreme percentiles stay accurate. Merging concatenates the
+    centroids and compresses them again to about `compression / 2`.
+
+    Compression is vectorized. Every centroid falls in the bin of the k1 scale
+    function (Dunning's asin scale) at its mid-rank, and each bin becomes one
+    centroid. Merged centroids are buffered and compressed once there are more
+    than `buffer` of them, so memory stays bounded however many sketches are
+    merged.
+    """
+
+    def __init__(self, compression=200, binary=None, buffer=4000):
+        self.compression = compression
+        self.buffer = buffer
+        self.pending = []
+        self.pending_size = 0
+        if binary is None:
+            self.min, self.max = np.inf, -np.inf
+            self.means, self.weights = np.empty(0), np.empty(0)
+        else:
+            values = np.frombuffer(binary, dtype=np.float64)
+            size = (len(values) - 2) // 2
+            self.min, self.max = values[0], values[1]
+            self.means, self.weights = values[2:2 + size].copy(), values[2 + size:].copy()
+
+    def add(self, values, weights=None):
+        """Add the values, each counted `weights` times (once by default)."""
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        kept = ~np.isnan(values)
+        values, weights = values[kept], weights[kept]
+        if len(values):
+            self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+            self._buffer(values, weights)
+        return self
+
+    def merge(self, other):
+        other.compress()
+        if len(other.means):
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+            self._buffer(other.means, other.weights)
+        return self
+
+    def _buffer(self, means, weights):
+        self.pending.append((means, weights))
+        self.pending_size += len(means)
+        if self.pending_size > self.buffer:
+            self.compress()
+
+    def compress(self):
+        if not self.pending:
+            return self
+        means = np.concatenate([self.means] + [means for means, _ in self.pending])
+        weights = np.concatenate([self.weights] + [weights for _, weights in self.pending])
+        self.pending, self.pending_size = [], 0
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        middle = (np.cumsum(weights) - weights / 2) / total
+        bins = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * middle - 1)).astype(np.int64)
+        # Consecutive centroids of the same bin are folded together
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        return self
+
+    def count(self):
+        self.compress()
+        return int(round(self.weights.sum()))
+
+    def quantile(self, q):
+        """Value at the rank q (0 to 1), interpolated between the centroids;
+        None for an empty sketch."""
+        self.compress()
+        if not len(self.means):
+            return None
+        total = self.weights.sum()
+        ranks = np.concatenate([[0], np.cumsum(self.weights) - self.weights / 2, [total]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * total, ranks, values))
+
+    def to_binary(self):
+        self.compress()
+        return Binary(np.concatenate([[self.min, self.max], self.means, self.weights]).tobytes())
+
+
+def refresh_value_sketches(db, days, compression=200):
+    """Rebuild the value sketches of the given days (midnight datetimes)."""
+    pipeline = [
+        {'$match': {'$or': [
+            {'Order Date': {'$gte': day, '$lt': day + timedelta(days=1)}}
+            for day in days
+        ]}},
+        # One product per order, so that a Product ID listed twice in Products
+        # does not count its orders twice
+        CATEGORY_LOOKUP,
+        # Like the rollup cube, orders without a product keep a null Category
+        {'$unwind': {'path': '$ProductDetails', 'preserveNullAndEmptyArrays': True}},
+        {'$group': dict(
+            {measure: {'$push': field} for measure, field in VALUE_MEASURES.items()},
+            _id={'day': DAY, 'Segment': '$Segment', 'Category': '$ProductDetails.Category'}
+        )}
+    ]
+    sketches = []
+    for row in db.Orders.aggregate(pipeline):
+        doc = dict(row.pop('_id'), compression=compression)
+        for measure in VALUE_MEASURES:
+            values = [value for value in row[measure] if isinstance(value, (int, float)) and not isinstance(value, bool)]
+            doc[measure] = TDigest(compression).add(values).to_binary()
+        sketches.append(doc)
+    db[VALUE_SKETCHES].delete_many({'day': {'$in': days}})
+    if sketches:
+        db[VALUE_SKETCHES].insert_many(sketches, ordered=False)
+
+
+def merged_value_sketches(db, measure, match, by=None):
+    """Merge the value sketches of `measure` matching `match` (on day, Segment
+    and Category), into one sketch per value of the `by` field, or one under
+    None. Empty when no sketch matches, None when orders were written since
+    the sketches were refreshed, or they never were."""
+    if not sketches_current(db):
+        return None
+    merged = {}
+    projection = {'_id': 0, 'compression': 1, measure: 1}
+    if by:
+        projection[by] = 1
+    for doc in db[VALUE_SKETCHES].find(match or {}, projection):
+        sketch = TDigest(doc['compression'], doc[measure])
+        key = doc.get(by) if by else None
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            merged[key] = sketch
+    return {key: sketch.compress() for key, sketch in merged.items()}
@@ -0,0 +1,150 @@
+"""Deterministic synthetic Superstore data: Orders, Products and Customers with
+the fields read by the API, from ten thousand to tens of millions of orders.
+
+The same seed and scale always give the same documents: orders are generated
+in fixed-size chunks, each from its own seeded random generator, and inserted
+chunk by chunk so memory stays bounded at any scale.
+
+    python synthetic.py --orders 1000000 --database ecommerce_bench
+"""
+import argparse
+import time
+
+import numpy as np
+from pymongo import MongoClient
+
+from cache import bump_data_version
+
+# Orders generated from one random generator; part of the determinism, not a tuning knob
+CHUNK_SIZE = 100_000
+INSERT_BATCH = 10_000
+
+SEGMENTS = ['Consumer', 'Corporate', 'Home Office']
+SEGMENT_WEIGHTS = [0.52, 0.30, 0.18]
+# Ship mode -> (share of orders, shortest and longest lead time in days)
+SHIP_MODES = {
+    'Standard Class': (0.60, 4, 7),
+    'Second Class': (0.19, 2, 5),
+    'First Class': (0.15, 1, 4),
+    'Same Day': (0.06, 0, 0)
+}
+CATEGORIES = {
+    'Furniture': ['Bookcases', 'Chairs', 'Furnishings', 'Tables'],
+    'Office Supplies': ['Appliances', 'Art', 'Binders', 'Envelopes', 'Fasteners', 'Labels', 'Paper',
+                        'Storage', 'Supplies'],
+    'Technology': ['Accessories', 'Copiers', 'Machines', 'Phones']
+}
+FIRST_NAMES = ['Claire', 'Darren', 'Sean', 'Brosina', 'Andrew', 'Irene', 'Harold', 'Pete', 'Alejandro',
+               'Zuschuss', 'Ken', 'Sandra', 'Emily', 'Eric', 'Tracy', 'Matt', 'Gene', 'Steve', 'Linda', 'Ruben']
+LAST_NAMES = ['Gute', 'Powers', "O'Donnell", 'Hoffman', 'Allen', 'Maddox', 'Pawlan', 'Kriz', 'Grove',
+              'Carroll', 'Black', 'Flanagan', 'Burns', 'Hoffmann', 'Blumstein', 'Abelman', 'Hale', 'Nguyen',
+              'Ausman', 'Dartt']
+
+
+def scale(orders):
+    """Number of customers and products of a dataset, grown with the orders like Superstore's."""
+    return int(np.clip(orders // 12, 100, 2_000_000)), int(np.clip(orders // 5, 50, 50_000))
+
+
+def customers(count, seed):
+    rng = np.random.default_rng([seed, 0])
+    first = rng.integers(len(FIRST_NAMES), size=count)
+    last = rng.integers(len(LAST_NAMES), size=count)
+    segment = rng.choice(len(SEGMENTS), size=count, p=SEGMENT_WEIGHTS)
+    return [{
+        'Customer ID': f"{FIRST_NAMES[f][0]}{LAST_NAMES[l][0]}-{10000 + i}",
+        'Customer Name': f"{FIRST_NAMES[f]} {LAST_NAMES[l]}",
+        'Segment': SEGMENTS[s]
+    } for i, (f, l, s) in enumerate(zip(first, last, segment))]
+
+
+def products(count, seed):
+    rng = np.random.default_rng([seed, 1])
+    pairs = [(category, sub) for category, subs in CATEGORIES.items() for sub in subs]
+    picked = rng.integers(len(pairs), size=count)
+    return [{
+        'Product ID': f"{pairs[p][0][:3].upper()}-{pairs[p][1][:2].upper()}-{10000000 + i}",
+        'Category': pairs[p][0],
+        'Sub-Category': pairs[p][1],
+        'Product Name': f"{pairs[p][1]} {i}"
+    } for i, p in enumerate(picked)]
+
+
+def orders_chunk(index, size, customer_docs, product_docs, start_year, years, seed):
+    """Orders of the chunk `index`, numbered after the previous chunks."""
+    rng = np.random.default_rng([seed, 2, index])
+    first_day = np.datetime64(f'{start_year}-01-01')
+    days = (np.datetime64(f'{start_year + years}-01-01') - first_day).astype(int)
+    # Sales grow over the years like the real dataset
+    order_date = first_day + (rng.random(size) ** 0.75 * days).astype(int)
+    modes = list(SHIP_MODES)
+    mode = rng.choice(len(modes), size=size, p=[share for share, _, _ in SHIP_MODES.values()])
+    low = np.array([SHIP_MODES[m][1] for m in modes])[mode]
+    high = np.array([SHIP_MODES[m][2] for m in modes])[mode]
+    lead_time = rng.integers(low, high + 1)
+    ship_date = order_date + lead_time
+    customer = rng.integers(len(customer_docs), size=size)
+    product = rng.integers(len(product_docs), size=size)
+    quantity = rng.integers(1, 15, size=size)
+    sales = np.round(rng.lognormal(4.5, 1.2, size=size) * quantity / 3, 4)
+    discount = rng.choice([0.0, 0.1, 0.2, 0.3, 0.5], size=size, p=[0.5, 0.15, 0.2, 0.1, 0.05])
+    profit = np.round(sales * (rng.normal(0.25, 0.12, size=size) - discount), 4)
+
+    order_dates = order_date.astype('datetime64[ms]').tolist()
+    ship_dates = ship_date.astype('datetime64[ms]').tolist()
+    first_row = index * CHUNK_SIZE
+    docs = []
+    for i in range(size):
+        buyer = customer_docs[customer[i]]
+        docs.append({
+            'Row ID': first_row + i + 1,
+            'Order ID': f"CA-{order_dates[i].year}-{100000 + first_row + i}",
+            'Order Date': order_dates[i],
+            'Ship Date': ship_dates[i],
+            'Ship Mode': modes[mode[i]],
+            'Lead Time': int(lead_time[i]),
+            'Customer ID': buyer['Customer ID'],
+            'Segment': buyer['Segment'],
+            'Product ID': product_docs[product[i]]['Product ID'],
+            'Sales': float(sales[i]),
+            'Quantity': int(quantity[i]),
+            'Discount': float(discount[i]),
+            'Profit': float(profit[i])
+        })
+    return docs
+
+
+def generate(db, orders, seed=42, start_year=2014, years=4, drop=True, progress=print):
+    """Load `orders` synthetic orders and their dimensions into `db`."""
+    customer_count, product_count = scale(orders)
+    if drop:
+        for collection in ('Orders', 'Products', 'Customers'):
+            db[collection].drop()
+    customer_docs = customers(customer_count, seed)
+    product_docs = products(product_count, seed)
+    db.Customers.insert_many([dict(doc) for doc in customer_docs], ordered=False)
+    db.Products.insert_many([dict(doc) for doc in product_docs], ordered=False)
+
+    start = time.perf_counter()
+    for index in range((orders + CHUNK_SIZE - 1) // CHUNK_SIZE):
+        size = min(CHUNK_SIZE, orders - index * CHUNK_SIZE)
+        docs = orders_chunk(index, size, customer_docs, product_docs, start_year, years, seed)
+        for batch in range(0, size, INSERT_BATCH):
+            db.Orders.insert_many(docs[batch:batch + INSERT_BATCH], ordered=False)
+        done = index * CHUNK_SIZE + size
+        progress(f"{done} / {orders} orders ({done / (time.perf_counter() - start):.0f} orders/s)")
+    bump_data_version(db)
+    return {'orders': orders, 'customers': customer_count, 'products': product_count, 'seed': seed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a deterministic synthetic Superstore dataset")
+    parser.add_argument("--orders", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--start-year", type=int, default=2014)
+    parser.add_argument("--years", type=int, default=4)
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="ecommerce_bench")
+    args = parser.parse_args()
+    client = MongoClient(args.mongo_url)
+    print(generate(client[args.database], args.orders, args.seed, args.start_year, args.years))
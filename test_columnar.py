@@ -0,0 +1,47 @@
+"""Parity of the columnar engine with the Orders pipelines on a small synthetic
+dataset, loaded into a scratch database of the MongoDB at MONGO_URL. Skipped
+when no mongod answers there.
+
+    python -m pytest test_columnar.py
+"""
+import os
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import columnar
+import synthetic
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017/")
+TEST_DATABASE = 'ecommerce_test_columnar'
+
+PARAMS = [
+    {}, {'year': 2015}, {'year': 2016, 'quarter': 2}, {'segment': 'Consumer'}, {'category': 'Technology'},
+    {'ship_mode': 'Standard Class', 'year': 2017}
+]
+
+
+@pytest.fixture(scope='module')
+def api():
+    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        pytest.skip(f"no mongod at {MONGO_URL}")
+    synthetic.generate(client[TEST_DATABASE], 5000, progress=lambda message: None)
+    # main reads its database at import
+    os.environ['MONGO_DB'] = TEST_DATABASE
+    import main
+    from fastapi.testclient import TestClient
+    yield TestClient(main.app)
+    client.drop_database(TEST_DATABASE)
+
+
+def test_columnar_matches_pipelines(api):
+    def fetch(endpoint, params):
+        response = api.get(f"/{endpoint}", params=params)
+        assert response.status_code == 200, (endpoint, params, response.text)
+        return response.json()
+
+    assert columnar.parity_failures(fetch, PARAMS) == []
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+METRICS = ('sales', 'profit', 'quantity', 'orders')
+
+# Measures of the rollup cube, for timeseries_pipeline(bucket, **CUBE_MEASURES)
+CUBE_MEASURES = {
+    'date': '$day', 'sales': '$sales', 'profit': '$profit', 'quantity': '$quantity', 'orders': '$orders'
+}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def timeseries_pipeline(bucket, date='$Order Date', sales='$Sales', profit='$Profit',
+                        quantity='$Quantity', orders=1):
+    """Sales, profit, quantity and order count per day, week or month, in date order."""
+    truncate = {'date': date, 'unit': bucket}
+    if bucket == 'week':
+        truncate['startOfWeek'] = 'monday'
+    return [
+        {'$group': {
+            '_id': {'$dateTrunc': truncate},
+            'sales': {'$sum': sales},
+            'profit': {'$sum': profit},
+            'quantity': {'$sum': quantity},
+            'orders': {'$sum': orders}
+        }},
+        {'$match': {'_id': {'$ne': None}}},
+        {'$sort': {'_id': 1}},
+        {'$project': {'_id': 0, 'date': '$_id', 'sales': 1, 'profit': 1, 'quantity': 1, 'orders': 1}}
+    ]
+
+
+def lttb(rows, threshold, x='date', y='sales'):
+    """Largest-Triangle-Three-Buckets downsampling of time-ordered rows to `threshold` points.
+
+    Keeps the first and last rows and, in each bucket in between, the row that
+    forms the largest triangle with the previously kept row and the average of
+    the next bucket, which preserves the visual shape of the series.
+    """
+    count = len(rows)
+    if threshold >= count or threshold < 3:
+        return rows
+    xs = [(row[x] - EPOCH).total_seconds() for row in rows]
+    ys = [row[y] or 0 for row in rows]
+    sampled = [rows[0]]
+    every = (count - 2) / (threshold - 2)
+    kept = 0
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, count)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, next_start):
+            area = abs((xs[kept] - avg_x) * (ys[j] - ys[kept]) - (xs[kept] - xs[j]) * (avg_y - ys[kept]))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(rows[best])
+        kept = best
+    sampled.append(rows[-1])
+    return sampled